@@ -3,6 +3,10 @@ __author__ = 'Arjun'
 from genericbuilder.baseclass import BaseGenericBuilder
 from genericbuilder.propdecorators import requires_built
 
+from .copy_tools import deepcopy_sharing_readonly
+from .parallel_tools import get_row_order
+
+import numpy as np
 from abc import abstractmethod
 
 
@@ -10,6 +14,10 @@ class BaseRateBuilder(BaseGenericBuilder):
 
     builder_type = 'rate'
 
+    # The names of the parameters that may have one value per channel (see
+    # _get_channel_param and _get_shard_copy)
+    channel_params = ()
+
     def __init__(self):
         """Constructor for BaseRateBuilder
 
@@ -100,3 +108,89 @@ class BaseRateBuilder(BaseGenericBuilder):
         it via X.rate_array.copy() or np.array(X.rate_array)
         """
         pass
+
+    def _get_channel_param(self, name, value, positive=False):
+        """
+        Converts the value of the parameter name, which is either a scalar or a 1-D array
+        with one value per channel (in the order of the channels property), into an
+        np.float64 scalar or a read-only (channels, 1) float64 array respectively, so
+        that it broadcasts against the rows of the rate array.
+
+        :param positive: If True, all the values must be positive
+        """
+        if np.ndim(value) > 1:
+            raise ValueError("'{}' can be at-most 1-D".format(name))
+        if np.ndim(value) == 0:
+            value = np.float64(value)
+        elif np.size(value) == self._channels.size:
+            value = np.array(value, dtype=np.float64).reshape((-1, 1))
+            value.setflags(write=False)
+        else:
+            raise ValueError("'{}' must be either a scalar or have one value per channel".format(name))
+        if positive and not np.all(value > 0):
+            raise ValueError("'{}' must have positive non-zero values".format(name))
+        return value
+
+    @staticmethod
+    def _get_channel_vector(param, nchannels):
+        """
+        Returns the parameter param (as returned by _get_channel_param) as a contiguous
+        1-D float64 array with one value per channel, as required by numba kernels
+        """
+        return np.ascontiguousarray(np.broadcast_to(param, (nchannels, 1))[:, 0], dtype=np.float64)
+
+    def _get_shard_copy(self, start, stop):
+        """
+        Returns a mutable copy of self restricted to the channels channels[start:stop],
+        where the per-channel parameters (channel_params) are restricted (and reordered
+        according to the channels of the copy) accordingly. Used for channel-sharded
+        builds (see parallel_tools)
+        """
+        shard_channels = self.channels[start:stop]
+        shard_builder = self.copy_mutable()
+        shard_builder.channels = shard_channels
+
+        param_order = get_row_order(shard_channels, shard_builder.channels)
+        for param_name in self.channel_params:
+            param = getattr(self, '_' + param_name)
+            if np.ndim(param) > 0:
+                shard_param = param[start:stop, 0]
+                setattr(shard_builder, param_name, shard_param if param_order is None else shard_param[param_order])
+        return shard_builder
+
+    def __deepcopy__(self, memo):
+        """
+        Deep copies of builders share the read-only (built and parameter) arrays, the
+        random generators and the contained builders' data with the original (see
+        ratebuilder.copy_tools). As these arrays are never modified in-place, this is
+        effectively copy-on-write.
+        """
+        return deepcopy_sharing_readonly(self, memo)
+
+    # ------------------------------------------------------------------------------------ #
+    # BUILD CACHE INTERFACE
+    # ------------------------------------------------------------------------------------ #
+    #
+    # See ratebuilder.build_cache. Builders that support caching implement _cache_params,
+    # _get_cached_arrays and _set_cached_arrays, and pass their build through the cache.
+
+    @property
+    def cache(self):
+        """
+        The ratebuilder.build_cache.BuildCache used to store and retrieve the results of
+        builds. None (default) disables caching. It has no effect on builders that do
+        not support caching
+        """
+        return getattr(self, '_cache', None)
+
+    @cache.setter
+    def cache(self, cache_):
+        self._cache = cache_
+
+    def _cache_params(self):
+        """
+        Returns a dict of all the parameters (including the random generator) that
+        determine the result of a build. Used to key the build caches.
+        """
+        raise NotImplementedError(
+            "Builder class '{}' does not support caching".format(self.__class__.__name__))
@@ -0,0 +1,298 @@
+# build_cache.py
+#
+#   Author: Arjun Rao
+#
+# This file contains an opt-in on-disk cache for the results of builds. The results of a build
+# are stored under a key that is a stable hash of the class of the builder and all the
+# parameters that determine the result of the build, including the state of the random
+# generator before the build. The arrays are stored as .npy files and are returned as read-only
+# memory maps. The states of the random generators after the build (including those of the
+# builders it contains, e.g. the rate builder of a spike builder) are stored as well, and are
+# restored when the results are retrieved, so that a cached build leaves the random generators
+# exactly as an actual build would.
+#
+# A builder supports caching if it implements the following methods
+#
+#   _cache_params()         returns a dict of everything that determines the result of the
+#                           build (including the random generator)
+#   _get_cached_arrays()    returns a dict {name: ndarray} of the results of the build
+#   _set_cached_arrays(d)   sets the results of the build from such a dict
+#
+# and its _build passes through BuildCache.cached_build when its 'cache' property is set.
+
+import os
+import types
+import shutil
+import pickle
+import hashlib
+import tempfile
+import functools
+
+import numpy as np
+
+from .rng_tools import get_rng_state, set_rng_state, get_builder_rngs
+
+
+class BuildCache:
+    """
+    Content-addressed on-disk cache of built rate and spike arrays.
+
+    :param directory: The directory in which the entries are stored (created if it
+        doesn't exist). The same directory can be shared by many builders, runs and
+        processes
+
+    :param max_bytes: The maximum total size of the entries. When exceeded after
+        storing a new entry, the least recently used entries are evicted. None (default)
+        means unlimited
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self._directory = os.path.abspath(directory)
+        os.makedirs(self._directory, exist_ok=True)
+        self._max_bytes = max_bytes
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def cached_build(self, builder, build_func, key=None):
+        """
+        If an entry for the builder exists, the arrays of the entry are set into the
+        builder and the random generators of the builder (see rng_tools.get_builder_rngs)
+        are set to their states after the cached build.
+        Otherwise build_func() is called to perform the build, and its results are
+        stored.
+
+        :param key: The key of the builder. This must be specified if the state of the
+            builder (e.g. of its random generator) has changed since the start of the
+            build. Defaults to get_build_key(builder)
+
+        :returns: True if the results were retrieved from the cache
+        """
+        if key is None:
+            key = get_build_key(builder)
+
+        # The random generators that are part of the key, including those of contained
+        # builders, as these may be advanced by the build as well (e.g. when a spike
+        # builder draws the rates in chunks)
+        rngs = get_builder_rngs(builder)
+        cache_entry = self._load(key)
+        if cache_entry is not None:
+            arrays, rng_states = cache_entry
+            builder._set_cached_arrays(arrays)
+            for rng, rng_state in zip(rngs, rng_states):
+                set_rng_state(rng, rng_state)
+            return True
+
+        build_func()
+        self._store(key, builder._get_cached_arrays(), [get_rng_state(rng) for rng in rngs])
+        return False
+
+    def clear(self):
+        """
+        Removes all the entries in the cache
+        """
+        for entry_name in self._get_entry_names():
+            shutil.rmtree(os.path.join(self._directory, entry_name), ignore_errors=True)
+
+    def _get_entry_names(self):
+        return [name for name in os.listdir(self._directory) if not name.startswith('.')]
+
+    def _load(self, key):
+        entry_path = os.path.join(self._directory, key)
+        if not os.path.isdir(entry_path):
+            return None
+
+        arrays = {}
+        for file_name in os.listdir(entry_path):
+            if file_name.endswith('.npy'):
+                file_path = os.path.join(entry_path, file_name)
+                try:
+                    arrays[file_name[:-4]] = np.load(file_path, mmap_mode='r')
+                except ValueError:
+                    # empty arrays cannot be memory mapped
+                    arrays[file_name[:-4]] = np.load(file_path)
+        with open(os.path.join(entry_path, 'rng_states.pkl'), 'rb') as rng_states_file:
+            rng_states = pickle.load(rng_states_file)
+
+        # The modification time of the entry is used as its last access time
+        os.utime(entry_path)
+        return arrays, rng_states
+
+    def _store(self, key, arrays, rng_states):
+        # The entry is written into a temporary directory which is then renamed, so that
+        # concurrent readers never see a partially written entry
+        temp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self._directory)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(temp_path, name + '.npy'), np.asarray(array))
+            with open(os.path.join(temp_path, 'rng_states.pkl'), 'wb') as rng_states_file:
+                pickle.dump(rng_states, rng_states_file)
+            os.replace(temp_path, os.path.join(self._directory, key))
+        except OSError:
+            # e.g. the entry has been stored concurrently by another process
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self._evict()
+
+    def _evict(self):
+        if self._max_bytes is None:
+            return
+
+        entries = []
+        for entry_name in self._get_entry_names():
+            entry_path = os.path.join(self._directory, entry_name)
+            try:
+                entry_size = sum(os.path.getsize(os.path.join(entry_path, file_name))
+                                 for file_name in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), entry_size, entry_path))
+            except OSError:
+                # evicted concurrently
+                pass
+
+        total_size = sum(entry_size for __, entry_size, __ in entries)
+        for __, entry_size, entry_path in sorted(entries):
+            if total_size <= self._max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= entry_size
+
+
+def is_cacheable(builder):
+    """
+    Returns True if the builder supports being cached (see module documentation)
+    """
+    try:
+        builder._cache_params()
+    except (AttributeError, NotImplementedError):
+        return False
+    return True
+
+
+def get_build_key(builder):
+    """
+    Returns the key of the builder in the cache. This is a hex string that is a stable
+    hash of the class of the builder and of its _cache_params() (including the current
+    state of its random generator)
+    """
+    hasher = hashlib.sha256()
+    _update_hash(hasher, builder, {})
+    return hasher.hexdigest()
+
+
+def _update_hash(hasher, value, memo):
+    # memo maps the id of each mutable container, object and function hashed so far to
+    # its index and the value itself (which is kept alive so that its id is not
+    # reused). A repeated value is hashed as a back-reference to its index, so that
+    # cyclic references (e.g. c.me = c, or mutually recursive functions) terminate
+    if isinstance(value, (dict, list, set)) or (
+            hasattr(value, '__dict__') and not isinstance(value, (type, types.ModuleType))):
+        if id(value) in memo:
+            hasher.update(b'V' + repr(memo[id(value)][0]).encode())
+            return
+        memo[id(value)] = (len(memo), value)
+
+    if value is None:
+        hasher.update(b'N')
+    elif isinstance(value, str):
+        hasher.update(b'S' + value.encode())
+    elif isinstance(value, bytes):
+        hasher.update(b'B' + value)
+    elif isinstance(value, np.dtype):
+        hasher.update(b'D' + value.str.encode())
+    elif isinstance(value, int) and not isinstance(value, bool):
+        # Python ints may not fit in an int64 (e.g. the 128-bit states of PCG64
+        # generators), in which case they would be converted to an object array
+        hasher.update(b'I' + repr(value).encode())
+    elif isinstance(value, np.ndarray) or np.isscalar(value):
+        array = np.ascontiguousarray(value)
+        hasher.update(b'A' + array.dtype.str.encode() + repr(array.shape).encode())
+        hasher.update(array.tobytes())
+    elif isinstance(value, (np.random.RandomState, np.random.Generator, np.random.SeedSequence)):
+        hasher.update(b'R')
+        _update_hash(hasher, get_rng_state(value), memo)
+    elif isinstance(value, dict):
+        hasher.update(b'M' + repr(len(value)).encode())
+        for item_key in sorted(value, key=repr):
+            _update_hash(hasher, item_key, memo)
+            _update_hash(hasher, value[item_key], memo)
+    elif isinstance(value, (tuple, list)):
+        hasher.update(b'L' + repr(len(value)).encode())
+        for item in value:
+            _update_hash(hasher, item, memo)
+    elif isinstance(value, (set, frozenset)):
+        # the iteration order of sets depends on the (randomised) string hashes
+        hasher.update(b'T' + repr(len(value)).encode())
+        for item in sorted(value, key=repr):
+            _update_hash(hasher, item, memo)
+    elif isinstance(value, types.ModuleType):
+        hasher.update(b'MD' + value.__name__.encode())
+    elif isinstance(value, type):
+        # classes (including builder classes, which have _cache_params) are identified
+        # by their name
+        _update_hash(hasher, _get_qualified_name(value), memo)
+    elif hasattr(value, '_cache_params'):
+        _update_hash(hasher, _get_qualified_name(type(value)), memo)
+        _update_hash(hasher, value._cache_params(), memo)
+    elif isinstance(value, functools.partial):
+        hasher.update(b'P')
+        _update_hash(hasher, value.func, memo)
+        _update_hash(hasher, value.args, memo)
+        _update_hash(hasher, value.keywords, memo)
+    elif isinstance(value, types.MethodType):
+        hasher.update(b'BM')
+        _update_hash(hasher, value.__func__, memo)
+        _update_hash(hasher, value.__self__, memo)
+    elif isinstance(value, types.FunctionType):
+        # Python functions are identified by their name and their code, including the
+        # values they capture and the globals they read (e.g. SCALE in
+        # lambda x: x*SCALE, or the helper functions they call), as names are not
+        # unique (e.g. all lambdas are '<lambda>')
+        hasher.update(b'F')
+        _update_hash(hasher, _get_qualified_name(value), memo)
+        _update_hash(hasher, value.__code__, memo)
+        _update_hash(hasher, value.__defaults__, memo)
+        _update_hash(hasher, value.__kwdefaults__, memo)
+        for cell in value.__closure__ or ():
+            try:
+                cell_contents = cell.cell_contents
+            except ValueError:
+                # empty cell
+                cell_contents = None
+            _update_hash(hasher, cell_contents, memo)
+        global_names = sorted(name for name in _get_code_names(value.__code__) if name in value.__globals__)
+        for name in global_names:
+            _update_hash(hasher, name, memo)
+            _update_hash(hasher, value.__globals__[name], memo)
+    elif isinstance(value, types.CodeType):
+        hasher.update(b'C' + value.co_code)
+        _update_hash(hasher, value.co_consts, memo)
+        _update_hash(hasher, value.co_names, memo)
+    elif callable(value) and hasattr(value, '__name__'):
+        # builtin functions (and numpy ufuncs) are identified by their name
+        _update_hash(hasher, _get_qualified_name(value), memo)
+    elif hasattr(value, '__dict__'):
+        # e.g. callable objects such as combine_sigmoid
+        _update_hash(hasher, _get_qualified_name(type(value)), memo)
+        _update_hash(hasher, vars(value), memo)
+    else:
+        hasher.update(b'O' + repr(value).encode())
+
+
+def _get_code_names(code):
+    """
+    Returns the set of names (of globals and attributes) used by the code object code,
+    including those used by the code objects nested in it (e.g. of inner lambdas)
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _get_code_names(const)
+    return names
+
+
+def _get_qualified_name(obj):
+    return '{}.{}'.format(getattr(obj, '__module__', ''), getattr(obj, '__qualname__', obj.__name__))
@@ -0,0 +1,171 @@
+# build_memo.py
+#
+#   Author: Arjun Rao
+#
+# This file contains an in-process, memory-bounded LRU memoisation of built builders. It is
+# used by the composite builders (CombinedRateBuilder, CombinedSpikeBuilder,
+# RateBasedSpikeBuilder) to build their constituents, so that repeated composite builds reuse
+# the constituents built earlier instead of regenerating them.
+#
+# A constituent is memoised under the same key as used by the on-disk cache (see
+# build_cache.get_build_key), i.e. its class, parameters and the state of its random generators
+# (including those of the builders it contains) before the build. On a hit, the random
+# generators are set to their state after the memoised build, and a copy of the memoised
+# builder holding the random generators of the builder being built is returned, exactly as if
+# the build had been performed. Builders that do not support caching, and
+# builders that use the global numpy random generator (whose state is shared by everything, so
+# that repeated builds practically never have the same key) are never memoised.
+#
+# Memoisation is disabled by default. Enable it by setting a budget, e.g.
+#
+#     from ratebuilder.build_memo import default_build_memo
+#     default_build_memo.max_bytes = 2**30
+
+import copy
+from collections import OrderedDict
+
+import numpy as np
+from numpy.random import mtrand
+
+from .build_cache import is_cacheable, get_build_key
+from .rng_tools import get_rng_state, set_rng_state, get_builder_rngs
+
+mtgen = mtrand.binomial.__self__
+
+
+class BuildMemo:
+    """
+    LRU memo of built (immutable) builders, bounded by the total size of their built
+    arrays.
+
+    :param max_bytes: The maximum total size of the built arrays held. 0 disables the
+        memo
+    """
+
+    def __init__(self, max_bytes=0):
+        self._entries = OrderedDict()  # key -> (built_builder, rngs, rng_states, nbytes)
+        self._total_bytes = 0
+        self.max_bytes = max_bytes
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes_):
+        if max_bytes_ >= 0:
+            self._max_bytes = int(max_bytes_)
+            self._evict()
+        else:
+            raise ValueError("'max_bytes' must be a non-negative integer")
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def clear(self):
+        self._entries.clear()
+        self._total_bytes = 0
+
+    def build_copy(self, builder):
+        """
+        Equivalent to builder.build_copy().set_immutable(), returning (a copy of) the
+        memoised built copy if one exists for the current configuration and random
+        generator states of builder
+        """
+        if self._max_bytes == 0 or not is_cacheable(builder):
+            return builder.build_copy().set_immutable()
+        rngs = get_builder_rngs(builder)
+        if any(rng is mtgen for rng in rngs):
+            return builder.build_copy().set_immutable()
+
+        key = get_build_key(builder)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            built_builder, entry_rngs, rng_states, __ = self._entries[key]
+            for rng, rng_state in zip(rngs, rng_states):
+                set_rng_state(rng, rng_state)
+            # The memoised builder holds the random generators of the builder it was
+            # built from. These are substituted by those of builder (which correspond
+            # one-to-one as the keys are equal), as a built copy of builder would hold
+            built_builder = copy.deepcopy(built_builder, {id(entry_rng): rng
+                                                          for entry_rng, rng in zip(entry_rngs, rngs)})
+            self._update_size(key)
+            self._evict()
+            return built_builder
+
+        built_builder = builder.build_copy().set_immutable()
+        nbytes = _get_built_nbytes(built_builder)
+        if nbytes <= self._max_bytes:
+            self._entries[key] = (built_builder, rngs, [get_rng_state(rng) for rng in rngs], nbytes)
+            self._total_bytes += nbytes
+            self._evict()
+        return built_builder
+
+    def _update_size(self, key):
+        # The derived arrays of the memoised builders (e.g. spike_step_array) are computed
+        # lazily on use, hence an entry is remeasured when it is accessed (remeasuring
+        # every entry on each access would cost O(entries))
+        built_builder, rngs, rng_states, nbytes = self._entries[key]
+        new_nbytes = _get_built_nbytes(built_builder)
+        self._entries[key] = (built_builder, rngs, rng_states, new_nbytes)
+        self._total_bytes += new_nbytes - nbytes
+
+    def _evict(self):
+        while self._total_bytes > self._max_bytes and self._entries:
+            __, (__, __, __, nbytes) = self._entries.popitem(last=False)
+            self._total_bytes -= nbytes
+
+
+default_build_memo = BuildMemo()
+
+
+def memoised_build_copy(builder):
+    """
+    Builds a copy of builder using default_build_memo (see BuildMemo.build_copy)
+    """
+    return default_build_memo.build_copy(builder)
+
+
+def _get_array_nbytes(array):
+    # Broadcast views (zero strides) only occupy the memory of the underlying array
+    array = np.asarray(array)
+    return array.itemsize*int(np.prod([n for n, stride in zip(array.shape, array.strides) if stride != 0]))
+
+
+def _get_built_nbytes(built_builder):
+    """
+    Returns the total size of the distinct memory buffers of all the arrays held by
+    built_builder, including those of the builders it contains (e.g. the built rate
+    builder of a RateBasedSpikeBuilder or the constituents of a CombinedRateBuilder) and
+    its derived arrays (e.g. the cached spike_step_array). Views are counted as the
+    array they are a view of
+    """
+    buffer_nbytes = {}
+    _collect_buffer_nbytes(built_builder, buffer_nbytes, set())
+    return sum(buffer_nbytes.values())
+
+
+def _collect_buffer_nbytes(value, buffer_nbytes, visited_ids):
+    if id(value) in visited_ids:
+        return
+    visited_ids.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            for item in value.ravel():
+                _collect_buffer_nbytes(item, buffer_nbytes, visited_ids)
+        else:
+            base_array = value
+            while isinstance(base_array.base, np.ndarray):
+                base_array = base_array.base
+            buffer_nbytes[id(base_array)] = _get_array_nbytes(base_array)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_buffer_nbytes(item, buffer_nbytes, visited_ids)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _collect_buffer_nbytes(item, buffer_nbytes, visited_ids)
+    elif hasattr(value, '_cache_params'):
+        # contained builders
+        _collect_buffer_nbytes(vars(value), buffer_nbytes, visited_ids)
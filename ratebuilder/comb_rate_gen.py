@@ -1,16 +1,53 @@
 from . import BaseRateBuilder
+from .const_rate_gen import ConstRateBuilder
 from genericbuilder.propdecorators import requires_built, prop_setter
 from genericbuilder.tools import get_builder_type
 
-from .combination_funcs import combine_sum
+from .combination_funcs import combine_sum, combine_weighted_sum, combine_sigmoid
+from .rng_tools import spawn_rngs, set_builder_rng, get_builder_rngs
+from .quantile_sketch import QuantileSketch, hist_match_sketch
+from .build_memo import memoised_build_copy
+import copy
 import numpy as np
+from numba import jit, prange
+
+# Number of quantiles in the quantile table of the template used for histogram equalization
+HIST_EQ_NQUANTILES = 4096
 
 
 class CombinedRateBuilder(BaseRateBuilder):
+    """
+    Combines the rate arrays of one or more rate builders via the function transform.
+
+    *use_hist_eq*
+      If True, the combined rates of each channel are histogram equalized such that
+      their distribution over time matches the distribution of the rates of the first
+      constituent rate builder (pooled over all its channels and time steps). This
+      way, the combination changes the temporal structure of the rates but not their
+      marginal distribution. See hist_match_rows
+
+    A ConstRateBuilder with a scalar rate contributes its rate to every channel of the
+    combined builder (irrespective of its own channels), whereas every other
+    constituent contributes (its rates) to its own channels only.
+
+    *rng*
+      If None (default), each constituent builds with its own random generator, so
+      that constituents sharing a generator are built in sequence and their results
+      depend on the order of the builds. If specified (np.random.Generator,
+      np.random.SeedSequence, np.random.RandomState or int seed), an independent
+      child Generator is spawned from it for every constituent at each build, and
+      assigned to it and the builders it contains (see rng_tools.spawn_rngs and
+      rng_tools.set_builder_rng). The result then only
+      depends on rng and the position of the constituent, so that the constituents
+      can be generated in any order or concurrently. An int seed is converted to a
+      np.random.SeedSequence when assigned, so that, as with the other types, each
+      build spawns new children (i.e. repeated builds give new realisations).
+    """
 
     built_properties = ['rate_array']
 
-    def __init__(self, rate_builders=(), transform=combine_sum, use_hist_eq=False):
+    def __init__(self, rate_builders=(), transform=combine_sum, use_hist_eq=False, dtype=np.float64,
+                 rng=None):
         # Initialization done directly as no None initializable property / function
         # corresponding to _rate_builders
         self._rate_builders = ()
@@ -19,14 +56,23 @@ class CombinedRateBuilder(BaseRateBuilder):
         self.add_rate_builders(rate_builders)
         self.transform = transform
         self.use_hist_eq = use_hist_eq
+        self.dtype = dtype
+        self.rng = rng
 
     def _preprocess(self):
         # Calculate dependent variables
         if self._rate_builders:
             self._steps_per_ms = self._rate_builders[0].steps_per_ms
-            combined_channels = sorted(set.union(*[set(rb.channels) for rb in self._rate_builders]))
-            self._channels = np.array(combined_channels, dtype=np.uint32())
-            self._channels.setflags(write=False)
+            self._channels = self._get_combined_channels()
+
+    def _get_combined_channels(self):
+        if self._rate_builders:
+            combined_channels = np.unique(np.concatenate([rb.channels for rb in self._rate_builders]))
+        else:
+            combined_channels = np.zeros(0)
+        combined_channels = combined_channels.astype(np.uint32)
+        combined_channels.setflags(write=False)
+        return combined_channels
 
     def _validate(self):
         step_length_set = set(int(rb.time_length*rb.steps_per_ms+0.5) for rb in self._rate_builders)
@@ -55,6 +101,32 @@ class CombinedRateBuilder(BaseRateBuilder):
     def use_hist_eq(self, use_hist_eq_):
         self._use_hist_eq = bool(use_hist_eq_)
 
+    @property
+    def dtype(self):
+        """
+        The floating point type of the combined rate array. The constituent rate arrays
+        are cast to this type before being combined
+        """
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, dtype_):
+        dtype_ = np.dtype(dtype_)
+        if np.issubdtype(dtype_, np.floating):
+            self._dtype = dtype_
+        else:
+            raise ValueError("'dtype' must be a floating point type")
+
+    @property
+    def rng(self):
+        return self._rng
+
+    @rng.setter
+    def rng(self, rng_):
+        # A SeedSequence is kept rather than the seed, as spawning from an int seed would
+        # create a new SeedSequence (and hence repeat the same children) at each build
+        self._rng = np.random.SeedSequence(rng_) if isinstance(rng_, (int, np.integer)) else rng_
+
     @property
     def rate_builders(self):
         return self._rate_builders
@@ -74,13 +146,22 @@ class CombinedRateBuilder(BaseRateBuilder):
 
     # channels and steps_per_ms cannot be set as they are entirely derived from the constiuent
     # rate-builders
+    # They are available before the build (e.g. for iter_chunks) as well
     @property
     def channels(self):
-        return self._channels
+        if hasattr(self, '_channels'):
+            return self._channels
+        else:
+            return self._get_combined_channels()
 
     @property
     def steps_per_ms(self):
-        return self._steps_per_ms
+        if hasattr(self, '_steps_per_ms'):
+            return self._steps_per_ms
+        elif self._rate_builders:
+            return self._rate_builders[0].steps_per_ms
+        else:
+            return np.uint32(1)
 
     @property
     def time_length(self):
@@ -104,33 +185,239 @@ class CombinedRateBuilder(BaseRateBuilder):
     def rate_array(self):
         return self._rate_array
 
+    def _cache_params(self):
+        return dict(rate_builders=self._rate_builders, transform=self._transform, use_hist_eq=self._use_hist_eq,
+                    dtype=self._dtype, rng=self._rng)
+
+    def _get_constituents(self):
+        """
+        Returns the constituent rate builders to be used for a build, i.e. the rate
+        builders themselves, or (if rng is specified) copies of them that are assigned
+        child generators of rng (see rng_tools.set_builder_rng)
+        """
+        if self._rng is None:
+            return self._rate_builders
+        constituents = []
+        for rb, child_rng in zip(self._rate_builders, spawn_rngs(self._rng, len(self._rate_builders))):
+            rb = rb.copy_mutable()
+            set_builder_rng(rb, child_rng)
+            constituents.append(rb.set_immutable())
+        return tuple(constituents)
+
     def _build(self):
-        # First, we build all the rate builders
-        new_built_rbs = []
-        for rb in self._rate_builders:
-            new_built_rbs.append(rb.build_copy())
-        self._rate_builders = tuple(new_built_rbs)
-
-        nchannels = self._channels.size
-        # Then, for each rate-builder we extend the first dimention to be equal to the number of
-        # channels with 0 as the output wherever there is no channel. If it is a zero dimensional
-        # array, we simply let it be
-        channel_index_map = {self._channels[i]: i for i in range(nchannels)}
-        output_rate_array_list = []
+        # First, we build all the rate builders (reusing earlier builds if memoised, see
+        # build_memo)
+        self._rate_builders = tuple(memoised_build_copy(rb) for rb in self._get_constituents())
+
+        # Rate builders that are constant in time (i.e. provide compact_rate_array) are
+        # combined in their compact form
+        rb_rate_arrays = []
         for rb in self._rate_builders:
-            if np.isscalar(rb.rate_array):
-                output_rate_array_list.append(rb.rate_array)
-            else:
-                channel_index_list = [channel_index_map[ch] for ch in rb._channels]
-                extended_rate_array = np.zeros((nchannels,) + rb.rate_array.shape[1:])
-                extended_rate_array[channel_index_list, ...] = rb.rate_array
-                output_rate_array_list.append(extended_rate_array)
+            rb_rate_array = getattr(rb, 'compact_rate_array', None)
+            rb_rate_arrays.append(rb.rate_array if rb_rate_array is None else rb_rate_array)
+
+        steps_length = int(self.time_length*self._steps_per_ms + 0.5)
+        final_rate_array = self._combine_rate_arrays(rb_rate_arrays, self._rate_builders, self._channels, steps_length)
 
-        final_rate_array = self._transform(output_rate_array_list)
-        if self._use_hist_eq:
-            # NEED TO WRITE code to implement hist eq
-            raise ValueError("histogram equalization not yet implemented")
+        if self._use_hist_eq and self._rate_builders:
+            # The equalization is done in-place if the combined array is not a broadcast
+            # view (it is never an array owned by a constituent as those are read-only)
+            out_array = final_rate_array if final_rate_array.flags.writeable else None
+            final_rate_array = hist_match_rows(final_rate_array, self._rate_builders[0].rate_array, out=out_array)
         self._rate_array = final_rate_array
+        self._rate_array.setflags(write=False)
+
+    def iter_chunks(self, chunk_steps, sketch_size=1024):
+        """
+        Generates the rate pattern as a sequence of time chunks (see
+        OURateBuilder.iter_chunks) by combining the chunks of the constituent rate
+        builders, all of which must support iter_chunks (e.g. OURateBuilder,
+        ConstRateBuilder, CombinedRateBuilder). This does not build the builder, and
+        the memory required is bounded by that of a single chunk of each constituent.
+
+        The transform is applied to each chunk separately. Hence this generates the
+        same process as build() only for transforms that act on each time step
+        independently (e.g. combine_sum, combine_weighted_sum but not
+        combine_sigmoid, whose maximum is taken per chunk).
+
+        With use_hist_eq, the chunks are generated in two passes. The first pass
+        summarises the distribution of the first constituent (the template) and that
+        of each channel of the combined rates in QuantileSketches, and the second
+        pass regenerates the same chunks (from copies of the random generators taken
+        before the first pass) and histogram matches them via hist_match_sketch (see
+        quantile_sketch.py). The quantiles of the result thus match those of build()
+        up to the accuracy of the sketches (of the order of 1/sketch_size).
+
+        :param chunk_steps: The maximum number of time steps in each chunk. The last
+            chunk may be shorter
+
+        :param sketch_size: The size of the QuantileSketches used for histogram
+            equalization (see QuantileSketch). Ignored if use_hist_eq is False
+
+        :returns: A generator yielding arrays of shape (len(channels), n) where n <=
+            chunk_steps. The chunks together span time_length
+        """
+        chunk_steps = int(chunk_steps)
+        if chunk_steps < 1:
+            raise ValueError("'chunk_steps' must be a positive integer")
+        if not all(hasattr(rb, 'iter_chunks') for rb in self._rate_builders):
+            raise ValueError("iter_chunks requires all the constituent rate builders to support iter_chunks")
+
+        constituents = self._get_constituents()
+        channels = self._get_combined_channels()
+        if self._use_hist_eq and constituents:
+            return self._generate_hist_eq_chunks(constituents, channels, chunk_steps, sketch_size)
+        else:
+            return self._generate_chunks(constituents, channels, chunk_steps)
+
+    def _generate_chunks(self, constituents, channels, chunk_steps):
+        for rb_rate_chunks in _zip_chunks(constituents, chunk_steps):
+            yield self._combine_rate_arrays(rb_rate_chunks, constituents, channels, rb_rate_chunks[0].shape[1])
+
+    def _generate_hist_eq_chunks(self, constituents, channels, chunk_steps, sketch_size):
+        # The first pass draws from copies of the random generators so that the second
+        # pass generates the same chunks and leaves the generators as a single pass would
+        rng_memo = {id(rng): copy.deepcopy(rng) for rng in get_builder_rngs(constituents)}
+        first_pass_constituents = copy.deepcopy(constituents, rng_memo)
+
+        template_sketch = QuantileSketch(sketch_size)
+        channel_sketches = [QuantileSketch(sketch_size) for __ in range(channels.size)]
+        for rb_rate_chunks in _zip_chunks(first_pass_constituents, chunk_steps):
+            template_sketch.update(rb_rate_chunks[0])
+            rate_chunk = self._combine_rate_arrays(rb_rate_chunks, first_pass_constituents, channels,
+                                                   rb_rate_chunks[0].shape[1])
+            for channel_sketch, rate_row in zip(channel_sketches, rate_chunk):
+                channel_sketch.update(rate_row)
+
+        # As in hist_match_rows, the rates are left unchanged if the template is empty
+        if not template_sketch.count:
+            yield from self._generate_chunks(constituents, channels, chunk_steps)
+            return
+
+        for rate_chunk in self._generate_chunks(constituents, channels, chunk_steps):
+            out_chunk = np.empty(rate_chunk.shape, dtype=self._dtype)
+            for channel_sketch, rate_row, out_row in zip(channel_sketches, rate_chunk, out_chunk):
+                hist_match_sketch(rate_row, channel_sketch, template_sketch, out=out_row)
+            yield out_chunk
+
+    def _combine_rate_arrays(self, rb_rate_arrays, rate_builders, channels, steps_length):
+        """
+        Combines the rate arrays of the rate builders (or chunks of them, spanning
+        steps_length time steps) into an array of shape (len(channels), steps_length)
+        using transform. The rate arrays may be compact i.e. of shape (n, 1)
+        """
+        nchannels = channels.size
+
+        # channels is sorted (see _preprocess) and hence the index of each channel of a
+        # constituent in channels is found via searchsorted. A scalar ConstRateBuilder is
+        # broadcast to all channels
+        is_broadcast_list = [isinstance(rb, ConstRateBuilder) and np.ndim(rb.rate) == 0 for rb in rate_builders]
+        channel_index_arrays = [np.arange(nchannels) if is_broadcast else np.searchsorted(channels, rb.channels)
+                                for rb, is_broadcast in zip(rate_builders, is_broadcast_list)]
+        rb_rate_arrays = [np.full((1, 1), rb.rate, dtype=self._dtype) if is_broadcast else rb_rate_array
+                          for rb, rb_rate_array, is_broadcast in zip(rate_builders, rb_rate_arrays, is_broadcast_list)]
+        if self._transform is combine_sum or isinstance(self._transform, (combine_weighted_sum, combine_sigmoid)):
+            # The combination is computed in-place into a single output array, the rows of
+            # each constituent being read directly at the indices of its channels. This
+            # avoids creating an extended copy of each constituent. If all the constituents
+            # are constant in time (i.e. provide compact_rate_array) the output is compact
+            # as well
+            is_compact = all(rb_rate_array.shape[1] == 1 for rb_rate_array in rb_rate_arrays)
+            final_rate_array = np.empty((nchannels, 1 if is_compact else steps_length), dtype=self._dtype)
+            self._transform(list(rb_rate_arrays), out=final_rate_array, row_inds_list=channel_index_arrays)
+        else:
+            # For each rate-builder we extend the first dimention to be equal to the number of
+            # channels with 0 as the output wherever there is no channel. Rate builders that
+            # are constant in time (i.e. provide compact_rate_array) are extended in their
+            # compact (channels, 1) form and are broadcast by the transform. Scalar
+            # ConstRateBuilders are passed as scalars
+            output_rate_array_list = []
+            for channel_index_array, rb_rate_array, is_broadcast in zip(channel_index_arrays, rb_rate_arrays,
+                                                                        is_broadcast_list):
+                if is_broadcast:
+                    output_rate_array_list.append(rb_rate_array[0, 0])
+                    continue
+                extended_rate_array = np.zeros((nchannels,) + rb_rate_array.shape[1:], dtype=self._dtype)
+                extended_rate_array[channel_index_array, ...] = rb_rate_array
+                output_rate_array_list.append(extended_rate_array)
+
+            final_rate_array = self._transform(output_rate_array_list)
+
+        # If all constituents are constant in time, the result is in the compact form
+        final_rate_array = np.asarray(final_rate_array, dtype=self._dtype)
+        if final_rate_array.shape != (nchannels, steps_length):
+            final_rate_array = np.broadcast_to(final_rate_array, (nchannels, steps_length))
+        return final_rate_array
+
+
+def _zip_chunks(rate_builders, chunk_steps):
+    """
+    Generates tuples of the corresponding chunks of the rate builders (see iter_chunks)
+    """
+    chunk_iters = [rb.iter_chunks(chunk_steps) for rb in rate_builders]
+    for rb_rate_chunks in zip(*chunk_iters):
+        chunk_length = rb_rate_chunks[0].shape[1]
+        assert all(rb_rate_chunk.shape[1] == chunk_length for rb_rate_chunk in rb_rate_chunks), \
+            "All constituent rate builders must have a common time length"
+        yield rb_rate_chunks
+
+
+def get_quantile_table(template, nquantiles=HIST_EQ_NQUANTILES):
+    """
+    Returns an array of nquantiles values containing the quantiles of the values in
+    template (flattened) at the probabilities np.linspace(0, 1, nquantiles). The
+    template is sorted only once. An empty template gives an empty table.
+    """
+    template_sorted = np.sort(template, axis=None)
+    if template_sorted.size == 0:
+        return np.zeros(0)
+    quantile_positions = np.linspace(0, template_sorted.size - 1, nquantiles)
+    return np.interp(quantile_positions, np.arange(template_sorted.size), template_sorted)
+
+
+def hist_match_rows(source, template, out=None, nquantiles=HIST_EQ_NQUANTILES):
+    """
+    Adjusts the values of each row of the 2-D array source such that the histogram of
+    each row matches the histogram of template (whose values are pooled over all its
+    elements).
+
+    The template is summarised once by a table of nquantiles quantiles (see
+    get_quantile_table). Each row is then sorted once, and the value of rank k (of n)
+    is replaced by the template quantile at probability (k + 0.5)/n (linearly
+    interpolated in the table). The rows are processed in parallel and the dtype of
+    source (e.g. float32) is retained. If template is empty, source is returned
+    unchanged (i.e. copied into out).
+
+    :param out: Array of the same shape and dtype as source into which the result is
+        written. This may be source itself. If None, a new array is allocated
+
+    :returns: out
+    """
+    if out is None:
+        out = np.empty(source.shape, dtype=source.dtype)
+    quantile_table = get_quantile_table(template, nquantiles).astype(out.dtype)
+    if quantile_table.size == 0:
+        out[...] = source
+    else:
+        _hist_match_rows_kernel(source, quantile_table, out)
+    return out
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _hist_match_rows_kernel(source, quantile_table, out):
+    nrows, ncols = source.shape
+    last_quantile = quantile_table.size - 1
+    for i in prange(nrows):
+        # The sort order is computed before anything is written, so out may be source
+        order = np.argsort(source[i, :])
+        for k in range(ncols):
+            quantile_position = (k + 0.5) / ncols * last_quantile
+            j = int(quantile_position)
+            if j >= last_quantile:
+                out[i, order[k]] = quantile_table[last_quantile]
+            else:
+                frac = quantile_position - j
+                out[i, order[k]] = quantile_table[j]*(1 - frac) + quantile_table[j + 1]*frac
 
 
 # histogram matching
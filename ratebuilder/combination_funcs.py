@@ -4,15 +4,36 @@
 #
 # This file contains functions and metafunctions that perform the combination of two or more arrays
 # to give a combined array. This is used to provide arguments to the CombinedRateBuilder.
+#
+# All the combination functions take the list of arrays to combine and the optional arguments
+# `out` and `row_inds_list`. If `out` is specified, the result is written into it (it must have
+# the broadcast shape of the arrays), otherwise a new array is allocated. If `row_inds_list` is
+# specified (along with `out`), the ith array provides only the rows row_inds_list[i] of the
+# result, and is treated as 0 in the other rows (this is how CombinedRateBuilder combines
+# constituents with different channels). The arrays are combined by numba kernels that read
+# each input array only once and do not allocate any temporaries.
 
 import numpy as np
+from numba import jit, prange
+
+
+def combine_sum(rate_array_list, out=None, row_inds_list=None):
+    return _combine_weighted(rate_array_list, np.ones(len(rate_array_list)), out, row_inds_list)[0]
+
+
+class combine_weighted_sum:
+    """
+    This is a class that returns a callable object that computes the weighted sum
+    sum(weights[i]*rate_array_list[i]) of the rate arrays
+    """
 
+    def __init__(self, weights):
+        self.weights = np.array(weights, dtype=np.float64)
 
-def combine_sum(rate_array_list):
-    return_arr = 0
-    for arr in rate_array_list:
-        return_arr = return_arr + arr
-    return return_arr
+    def __call__(self, rate_array_list, out=None, row_inds_list=None):
+        assert len(rate_array_list) == len(self.weights), \
+            "The number of weights must be equal to the number of rate arrays"
+        return _combine_weighted(rate_array_list, self.weights, out, row_inds_list)[0]
 
 
 class combine_sigmoid:
@@ -20,20 +41,106 @@ class combine_sigmoid:
     This is a class that returns a callable object that represents the appropriate
     sigmoid function to be used in CombinedRateBuilder. See code to find out what
     it does. it's simple enough
+
+    The sigmoid is applied to the sum of any number of rate arrays, with f_max being
+    the maximum over all the rate arrays
     """
 
     def __init__(self, K, M):
-        self.K = np.float(K)
-        self.M = np.float(M)
+        self.K = np.float64(K)
+        self.M = np.float64(M)
+
+    def __call__(self, rate_array_list, out=None, row_inds_list=None):
+        assert len(rate_array_list) >= 1, "sigmoidal combination requires at-least 1 rate array"
+        x, f_max = _combine_weighted(rate_array_list, np.ones(len(rate_array_list)), out, row_inds_list)
+
+        # Computes f_max/(1+np.exp(-2*K*(x-1.0*M*f_max)/f_max)) in-place
+        _sigmoid_inplace(_as_2d(x), f_max, self.K, self.M)
+        return x
+
+
+def _as_2d(array):
+    """
+    Returns a 2-D view of array (the kernels below operate on 2-D arrays)
+    """
+    if array.ndim < 2:
+        return np.atleast_2d(array)
+    elif array.ndim > 2:
+        return array.reshape(-1, array.shape[-1])
+    else:
+        return array
+
+
+def _combine_weighted(rate_array_list, weights, out, row_inds_list=None):
+    """
+    Computes the weighted sum of the rate arrays (which may be scalars or arrays that
+    broadcast against each other) into out (allocated if None). If row_inds_list is
+    specified, out must be specified as well, and the ith rate array (which broadcasts
+    against out[row_inds_list[i]]) is added to the rows row_inds_list[i] of out only.
+    An empty list of rate arrays sums to 0.
+
+    :returns: (out, max_value) where max_value is the maximum over all the (unweighted)
+        rate arrays (including the zeros of the rows not provided by a rate array)
+    """
+    if out is None:
+        assert row_inds_list is None, "'out' must be specified along with 'row_inds_list'"
+        if not rate_array_list:
+            return 0, -np.inf
+        out_shape = np.broadcast_shapes(*[np.shape(arr) for arr in rate_array_list])
+        out = np.empty(out_shape, dtype=np.result_type(*rate_array_list))
+    if not rate_array_list:
+        out[...] = 0
+        return out, -np.inf
+
+    out_2d = _as_2d(out)
+    if row_inds_list is None:
+        # Each rate array provides all the rows, so that out is initialized by the first
+        row_inds_list = [np.arange(out_2d.shape[0])]*len(rate_array_list)
+        rate_arrays_2d = [_as_2d(np.broadcast_to(rate_array, out.shape)) for rate_array in rate_array_list]
+        initialize = True
+    else:
+        rate_arrays_2d = [np.broadcast_to(rate_array, (len(row_inds), out_2d.shape[1]))
+                          for rate_array, row_inds in zip(rate_array_list, row_inds_list)]
+        out_2d[...] = 0
+        initialize = False
+
+    max_value = -np.inf
+    for i, (rate_array_2d, row_inds, weight) in enumerate(zip(rate_arrays_2d, row_inds_list, weights)):
+        row_inds = np.asarray(row_inds, dtype=np.int64)
+        row_max = np.empty(row_inds.size, dtype=np.float64)
+        _accumulate_weighted(out_2d, rate_array_2d, row_inds, weight, initialize and i == 0, row_max)
+        if row_max.size:
+            max_value = max(max_value, np.amax(row_max))
+        if row_inds.size < out_2d.shape[0]:
+            max_value = max(max_value, 0.0)
+    return out, max_value
 
-    def __call__(self, rate_array_list):
-        assert len(rate_array_list) == 2, "sigmoidal combination is only valid for 2 rate arrays"
-        A = rate_array_list[0]
-        B = rate_array_list[1]
-        f_max = max(np.amax(A), np.amax(B))
-        x = A + B
 
-        K = self.K
-        M = self.M
+@jit(nopython=True, parallel=True, cache=True)
+def _accumulate_weighted(out, rate_array, row_inds, weight, initialize, row_max):
+    """
+    out[row_inds] = weight*rate_array if initialize else out[row_inds] + weight*rate_array,
+    while computing the maximum of each row of rate_array into row_max in the same pass.
+    row_inds must not contain duplicates
+    """
+    nrows, ncols = rate_array.shape
+    for i in prange(nrows):
+        out_row = row_inds[i]
+        curr_max = -np.inf
+        for j in range(ncols):
+            x = rate_array[i, j]
+            if x > curr_max:
+                curr_max = x
+            if initialize:
+                out[out_row, j] = weight*x
+            else:
+                out[out_row, j] += weight*x
+        row_max[i] = curr_max
+
 
-        return f_max/(1+np.exp(-2*K*(x-1.0*M*f_max)/f_max))
+@jit(nopython=True, parallel=True, cache=True)
+def _sigmoid_inplace(x, f_max, K, M):
+    nrows, ncols = x.shape
+    for i in prange(nrows):
+        for j in range(ncols):
+            x[i, j] = f_max/(1 + np.exp(-2*K*(x[i, j] - 1.0*M*f_max)/f_max))
@@ -4,15 +4,29 @@ import numpy as np
 
 
 class ConstRateBuilder(BaseRateBuilder):
+    """
+    Rate builder generating a rate that is constant in time. The rate can either be a
+    scalar (same for all channels) or a vector with one rate per channel.
+
+    The rate_array is a read-only broadcast view of shape (channels, steps) over a
+    (channels, 1) array, and thus costs O(channels) memory irrespective of the
+    time length. Consumers that can exploit the constancy can use compact_rate_array
+    (the underlying (channels, 1) array) directly.
+    """
+
+    built_properties = ['rate_array', 'compact_rate_array']
+    channel_params = ('rate',)
 
     def __init__(self, rate,
-                 channels=[], steps_per_ms=1, time_length=0):
+                 channels=[], steps_per_ms=1, time_length=0, dtype=np.float64):
         super().__init__()  # only purpose is to run BaseGenericBuilder init
 
+        self._steps_length = np.uint32(0)
         self.channels = channels
         self.rate = rate
         self.steps_per_ms = steps_per_ms
         self.time_length = time_length
+        self.dtype = dtype
 
     def _validate(self):
         pass
@@ -41,6 +55,18 @@ class ConstRateBuilder(BaseRateBuilder):
             assert np.all(rate >= 0), "'rate' must be a non-negative number"
         self._rate = rate
 
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, dtype_):
+        dtype_ = np.dtype(dtype_)
+        if np.issubdtype(dtype_, np.floating):
+            self._dtype = dtype_
+        else:
+            raise ValueError("'dtype' must be a floating point type")
+
     @property
     def steps_per_ms(self):
         """
@@ -112,7 +138,55 @@ class ConstRateBuilder(BaseRateBuilder):
     @property
     @requires_built
     def rate_array(self):
+        """
+        Read-only array of shape (channels, steps) which is a broadcast view of
+        compact_rate_array (i.e. it is not materialised in memory). Copy it via
+        X.rate_array.copy() or np.array(X.rate_array) in order to obtain a writable
+        array
+        """
         return self._rate_array
 
+    @property
+    @requires_built
+    def compact_rate_array(self):
+        """
+        Read-only array of shape (channels, 1) containing the rate of each channel.
+        This broadcasts against arrays of the shape of rate_array
+        """
+        return self._compact_rate_array
+
+    def _cache_params(self):
+        return dict(rate=self._rate, channels=self._channels, steps_per_ms=self._steps_per_ms,
+                    time_length=self._time_length, dtype=self._dtype)
+
     def _build(self):
-        self._rate_array = self._rate
+        nchannels = self._channels.size
+        self._compact_rate_array = self._get_compact_rate_array()
+        self._rate_array = np.broadcast_to(self._compact_rate_array, (nchannels, int(self._steps_length)))
+
+    def _get_compact_rate_array(self):
+        compact_rate_array = np.array(np.broadcast_to(self._rate, (self._channels.size, 1)), dtype=self._dtype)
+        compact_rate_array.setflags(write=False)
+        return compact_rate_array
+
+    def iter_chunks(self, chunk_steps):
+        """
+        Generates the rate pattern as a sequence of time chunks (see
+        OURateBuilder.iter_chunks). The chunks are read-only broadcast views of the
+        compact rate array, and thus cost O(channels) memory each. This does not build
+        the builder.
+
+        :param chunk_steps: The maximum number of time steps in each chunk. The last
+            chunk may be shorter
+
+        :returns: A generator yielding arrays of shape (len(channels), n) where n <=
+            chunk_steps. The chunks together span time_length
+        """
+        chunk_steps = int(chunk_steps)
+        if chunk_steps < 1:
+            raise ValueError("'chunk_steps' must be a positive integer")
+
+        steps_length = int(self._time_length * self._steps_per_ms + 0.5)
+        compact_rate_array = self._get_compact_rate_array()
+        return (np.broadcast_to(compact_rate_array, (self._channels.size, min(chunk_steps, steps_length - chunk_start)))
+                for chunk_start in range(0, steps_length, chunk_steps))
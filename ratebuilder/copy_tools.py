@@ -0,0 +1,48 @@
+# copy_tools.py
+#
+#   Author: Arjun Rao
+#
+# This file contains the function implementing the copy-on-write style sharing used when
+# (deep) copying builders. The built arrays and the parameter arrays of the builders are set
+# read-only and are only ever replaced (never modified in-place), so that a copy can share them
+# with the original instead of duplicating them. Random generators are shared as well, as is
+# the convention for all builders (a copy draws from the same generator as the original).
+
+import copy
+import types
+
+import numpy as np
+
+_shared_types = (np.random.RandomState, np.random.Generator, np.random.SeedSequence,
+                 types.FunctionType, types.BuiltinFunctionType, np.ufunc, type)
+
+
+def deepcopy_sharing_readonly(obj, memo):
+    """
+    Returns a deep copy of obj (to be used in obj.__deepcopy__) in which the read-only
+    numpy arrays, random generators and functions held by obj are shared with obj
+    rather than copied. Contained builders are copied in the same manner, so copying
+    a tree of builders costs O(number of builders) irrespective of the size of the
+    built data.
+    """
+    new_obj = obj.__class__.__new__(obj.__class__)
+    memo[id(obj)] = new_obj
+    for name, value in obj.__dict__.items():
+        # object.__setattr__ bypasses any property / mutability checks as this only
+        # replicates existing state
+        object.__setattr__(new_obj, name, _copy_value(value, memo))
+    return new_obj
+
+
+def _copy_value(value, memo):
+    if id(value) in memo:
+        # e.g. shared objects substituted via the memo (see build_memo)
+        return memo[id(value)]
+    elif isinstance(value, np.ndarray) and not value.flags.writeable:
+        return value
+    elif isinstance(value, _shared_types):
+        return value
+    elif isinstance(value, tuple) and all(isinstance(x, np.ndarray) and not x.flags.writeable for x in value):
+        return value
+    else:
+        return copy.deepcopy(value, memo)
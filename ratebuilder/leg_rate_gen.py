@@ -2,9 +2,11 @@ from . import BaseRateBuilder
 
 import numpy as np
 from numpy.random import mtrand
-from numba import jit
+from numba import jit, prange
 from genericbuilder.propdecorators import requires_built
 
+from .rng_tools import draw_seeds
+
 mtgen = mtrand.binomial.__self__
 
 
@@ -51,6 +53,10 @@ class LegacyRateBuilder(BaseRateBuilder):
       The ou_theta parameter used in the discrete time ou simulation. It
       should be in 1/ms
 
+    Each of mean, sigma and theta can either be a scalar (same for all channels) or a
+    vector with one value per channel (in the order of the channels property). All the
+    channels are simulated in the same parallel kernel in either case.
+
     *delay*
       The number of TIME STEPS (note. this is NOT INVARIANT to step size) to
       delay before taking the results (allows for burn-in time)
@@ -63,8 +69,12 @@ class LegacyRateBuilder(BaseRateBuilder):
     ----------------
 
     *rng*
-      Specify a random generator for use. If unspecified, defaults to the
-      one used by numpy)
+      Specify a random generator (np.random.RandomState or np.random.Generator)
+      for use. If unspecified, defaults to the one used by numpy)
+
+    *dtype*
+      The floating point type used for the simulation and the rate array.
+      np.float32 halves the memory footprint. Defaults to np.float64
 
     Algorithm
     =========
@@ -82,10 +92,11 @@ class LegacyRateBuilder(BaseRateBuilder):
     """
 
     built_properties = 'rate_array'
+    channel_params = ('mean', 'sigma', 'theta')
 
     def __init__(self, mean, sigma, theta, delay, max_rate,
                  channels=[], steps_per_ms=1, time_length=0,
-                 rng=mtgen):
+                 rng=mtgen, dtype=np.float64):
         """
         Relevant fields in the config_dict can be seen in the Parameters
         section of the Class documentation
@@ -99,6 +110,7 @@ class LegacyRateBuilder(BaseRateBuilder):
 
         # Assigning the random generator
         self.rng = rng
+        self.dtype = dtype
 
         # Assigning the compulsory / positional arguments
         self.mean = mean
@@ -112,38 +124,68 @@ class LegacyRateBuilder(BaseRateBuilder):
         self._steps_length = int(self._time_length*self._steps_per_ms + 0.5)
 
     def _validate(self):
-        pass
+        for param_name in ('mean', 'sigma', 'theta'):
+            param = getattr(self, '_' + param_name)
+            if np.ndim(param) > 0 and param.shape[0] != self._channels.size:
+                raise ValueError("The per-channel parameter '{}' must have one value per channel"
+                                 .format(param_name))
 
     @staticmethod
-    @jit(nopython=True, cache=True)
-    def _fast_build(std_normal_array, sigma, mean, theta, steps_per_ms, log_max_rate):
-        x = np.zeros_like(std_normal_array, np.float64)
-        x[:, 0] = mean + std_normal_array[:, 0]
-        sim_length = std_normal_array.shape[1]
-        for i in range(sim_length-1):
-            x[:, i+1] = x[:, i] + (theta*(mean - x[:, i]) + std_normal_array[:, i+1]*sigma)/steps_per_ms
-            x[x[:, i+1] > log_max_rate, i+1] = log_max_rate
-
-        return x
+    @jit(nopython=True, parallel=True, cache=True)
+    def _fast_build(rate_array, seeds, sigma, mean, theta, steps_per_ms, log_max_rate, delay):
+        """
+        Simulates the difference equation (see class documentation) for each channel
+        (in parallel) with the parameters sigma[c], mean[c] and theta[c], writing
+        exp(x[delay:]) directly into rate_array. The noise is
+        drawn in the kernel from numba's random generator seeded with seeds[c] for
+        channel c, and the burn-in steps are not stored.
+        """
+        nchannels, steps_length = rate_array.shape
+        for c in prange(nchannels):
+            np.random.seed(seeds[c])
+            sigma_c = sigma[c]
+            mean_c = mean[c]
+            theta_c = theta[c]
+            x = mean_c + np.random.standard_normal()
+            if delay == 0 and steps_length > 0:
+                rate_array[c, 0] = np.exp(x)
+            for i in range(1, delay + steps_length):
+                x = x + (theta_c*(mean_c - x) + np.random.standard_normal()*sigma_c)/steps_per_ms
+                if x > log_max_rate:
+                    x = log_max_rate
+                if i >= delay:
+                    rate_array[c, i - delay] = np.exp(x)
+
+    def _cache_params(self):
+        return dict(mean=self._mean, sigma=self._sigma, theta=self._theta, delay=self._delay,
+                    max_rate=self._max_rate, channels=self._channels, steps_per_ms=self._steps_per_ms,
+                    time_length=self._time_length, rng=self._rng, dtype=self._dtype)
+
+    def _get_cached_arrays(self):
+        return {'rate_array': self._rate_array}
+
+    def _set_cached_arrays(self, arrays):
+        self._rate_array = arrays['rate_array']
 
     def _build(self):
+        if self.cache is None:
+            self._build_rate_array()
+        else:
+            self.cache.cached_build(self, self._build_rate_array)
+
+    def _build_rate_array(self):
         nchannels = self._channels.size
-        simlength = self._delay + self._steps_length
-        sim_array_size = (nchannels, simlength)
-
-        theta = self._theta
-        mean = self._mean
-        sigma = self._sigma
-        log_max_rate = np.log(self._max_rate)
-        std_normal_array = self._rng.normal(size=sim_array_size)
-
-        x = LegacyRateBuilder._fast_build(std_normal_array=std_normal_array,
-                                          sigma=sigma,
-                                          mean=mean,
-                                          theta=theta,
-                                          steps_per_ms=self._steps_per_ms,
-                                          log_max_rate=log_max_rate)
-        self._rate_array = np.exp(x[:, self._delay:])
+        rate_array = np.empty((nchannels, self._steps_length), dtype=self._dtype)
+
+        LegacyRateBuilder._fast_build(rate_array=rate_array,
+                                      seeds=draw_seeds(self._rng, nchannels),
+                                      sigma=self._get_channel_vector(self._sigma, nchannels),
+                                      mean=self._get_channel_vector(self._mean, nchannels),
+                                      theta=self._get_channel_vector(self._theta, nchannels),
+                                      steps_per_ms=float(self._steps_per_ms),
+                                      log_max_rate=np.log(self._max_rate),
+                                      delay=int(self._delay))
+        self._rate_array = rate_array
         self._rate_array.setflags(write=False)
 
     @property
@@ -152,7 +194,7 @@ class LegacyRateBuilder(BaseRateBuilder):
 
     @mean.setter
     def mean(self, mean_):
-        self._mean = np.float_(mean_)
+        self._mean = self._get_channel_param('mean', mean_)
 
     @property
     def sigma(self):
@@ -160,10 +202,7 @@ class LegacyRateBuilder(BaseRateBuilder):
 
     @sigma.setter
     def sigma(self, sigma_):
-        if sigma_ > 0:
-            self._sigma = np.float_(sigma_)
-        else:
-            raise ValueError("'sigma' must be positive")
+        self._sigma = self._get_channel_param('sigma', sigma_, positive=True)
 
     @property
     def theta(self):
@@ -171,8 +210,9 @@ class LegacyRateBuilder(BaseRateBuilder):
 
     @theta.setter
     def theta(self, theta_):
-        if self._steps_per_ms > theta_ > 0:
-            self._theta = np.float_(theta_)
+        theta_ = self._get_channel_param('theta', theta_, positive=True)
+        if np.all(theta_ < self._steps_per_ms):
+            self._theta = theta_
         else:
             raise ValueError("'theta' must be between 0 and {} for stable filter".format(self._steps_per_ms))
 
@@ -206,6 +246,18 @@ class LegacyRateBuilder(BaseRateBuilder):
     def rng(self, rng_):
         self._rng = rng_
 
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, dtype_):
+        dtype_ = np.dtype(dtype_)
+        if np.issubdtype(dtype_, np.floating):
+            self._dtype = dtype_
+        else:
+            raise ValueError("'dtype' must be a floating point type")
+
     @property
     def steps_per_ms(self):
         """
@@ -3,13 +3,31 @@ __author__ = 'Arjun'
 from . import BaseRateBuilder
 from genericbuilder.propdecorators import requires_built
 
+import copy
 import numpy as np
 from numpy.random import mtrand
 import scipy.signal as sg
+from numba import jit, prange
 from collections import namedtuple
 
+from .rng_tools import std_normal, spawn_rngs, draw_seeds, ChannelRNGs
+from .parallel_tools import get_shard_bounds, get_row_order, build_sharded_array
+
 mtgen = mtrand.binomial.__self__
 
+# Defined at module level so that builders holding DT params can be pickled (e.g. when sent
+# to worker processes)
+DT_param_struct = namedtuple('DT_param_struct', ['mean', 'theta', 'sigma'])
+
+# The 'numba' engine reseeds the generator of each channel at the start of every block of
+# this many time steps (see _numba_filter_block)
+NUMBA_SEED_BLOCK_STEPS = 4096
+
+# With the 'scipy' engine, if more than this fraction of the channels have distinct
+# values of theta, the noise is filtered per channel by _numba_filter_rows instead of
+# one lfilter call per distinct value
+MAX_LFILTER_GROUP_FRACTION = 0.25
+
 
 class OURateBuilder(BaseRateBuilder):
     """Rate Generator via Homogenous OU Process
@@ -25,10 +43,38 @@ class OURateBuilder(BaseRateBuilder):
     2.  sigma - [Hz]   The scaling of the Wiener Process
     3.  theta - [1/ms] The rate of decay of OU Process towards mean
 
+    Each of these can either be a scalar (same for all channels) or a vector with one
+    value per channel (in the order of the channels property), so that a heterogeneous
+    population is generated in the same single pass as a homogeneous one. With the
+    'scipy' engine, channels with different theta are filtered in groups (one lfilter
+    call per distinct value of theta), or per channel by a numba kernel when nearly
+    every value is distinct. The 'numba' engine has no such overhead.
+
     The differential equation is
 
         dx = theta(mu - x)dt + sigma*dW
 
+    Other Parameters
+
+    1.  rng     - np.random.RandomState or np.random.Generator used for the build
+    2.  dtype   - floating point type of the rate array (default np.float64)
+    3.  workers - number of processes used for the build (default 1). If greater than
+                  1, the channels are split into `workers` shards, each built in a
+                  separate process with its own random generator spawned from rng
+                  (see rng_tools.spawn_rngs). The result is reproducible for a given
+                  state of rng and number of workers
+    4.  engine  - 'scipy' (default) or 'numba'. 'scipy' filters a pre-drawn noise array
+                  using scipy.signal.lfilter. 'numba' uses a fused kernel parallelized
+                  over channels that draws the noise, runs the AR(1) recursion and adds
+                  the mean in a single pass, writing straight into the rate array (see
+                  _numba_filter_block)
+    5.  seed    - None (default) or an integer seed. If specified, rng is not used and
+                  each channel is generated from its own stream derived from (seed,
+                  channel) (see rng_tools.ChannelRNGs), so that the realisation of a
+                  channel does not depend on the other channels. This allows growing the
+                  channels of a built builder via add_channels, and makes the result
+                  independent of the number of workers
+
     where W is a wiener process with variance given as
 
         var(W(t+h) - W(t)) = alpha h
@@ -55,10 +101,11 @@ class OURateBuilder(BaseRateBuilder):
     """
 
     built_properties = ['rate_array']
+    channel_params = ('mean', 'sigma', 'theta')
 
     def __init__(self, mean, sigma, theta,
                  channels=[], steps_per_ms=1, time_length=0,
-                 rng=mtgen):
+                 rng=mtgen, dtype=np.float64, workers=1, engine='scipy', seed=None):
 
         super().__init__()  # only purpose is to run BaseGenericBuilder init
 
@@ -72,6 +119,8 @@ class OURateBuilder(BaseRateBuilder):
         self._channels = np.zeros(0)
 
         self._rng = mtgen
+        # The state array of the per-channel streams after the last step (see extend)
+        self._stream_states = None
 
         # Setting Core parameters
         self.steps_per_ms = steps_per_ms
@@ -80,6 +129,10 @@ class OURateBuilder(BaseRateBuilder):
 
         # setting random number generator
         self.rng = rng
+        self.dtype = dtype
+        self.workers = workers
+        self.engine = engine
+        self.seed = seed
 
         # Setting OU Parameters
         self.mean = mean
@@ -87,7 +140,11 @@ class OURateBuilder(BaseRateBuilder):
         self.theta = theta
 
     def _validate(self):
-        pass
+        for param_name in ('mean', 'sigma', 'theta'):
+            param = getattr(self, '_' + param_name)
+            if np.ndim(param) > 0 and param.shape[0] != self._channels.size:
+                raise ValueError("The per-channel parameter '{}' must have one value per channel"
+                                 .format(param_name))
 
     def _preprocess(self):
         self._steps_length = np.uint32(self._time_length * self._steps_per_ms + 0.5)
@@ -95,15 +152,18 @@ class OURateBuilder(BaseRateBuilder):
 
     def convert_params_CT_to_DT(self):
         """Performs conversion between CT and DT Params"""
-        mean = self._mean
-        sigma = self._sigma
-        theta = self._theta
+        return self._get_DT_params(self._mean, self._sigma, self._theta)
+
+    def _get_DT_params(self, mean, sigma, theta):
+        """
+        Converts the given CT Params (scalars or (channels, 1) arrays) into DT Params
+        """
         h = 1 / self._steps_per_ms
 
         mean_DT = mean
         theta_DT = (1 - np.exp(-theta * h)) / h
         sigma_DT = sigma * np.sqrt(theta_DT * (2 - theta_DT * h) / (2 * h * theta))  # ignoring alpha = 1
-        DT_params = namedtuple('DT_param_struct', ['mean', 'theta', 'sigma'])(
+        DT_params = DT_param_struct(
             mean=mean_DT,
             theta=theta_DT,
             sigma=sigma_DT)
@@ -119,7 +179,7 @@ class OURateBuilder(BaseRateBuilder):
 
     @mean.setter
     def mean(self, mean_):
-        self._mean = np.float64(mean_)
+        self._mean = self._get_channel_param('mean', mean_)
 
     @property
     def sigma(self):
@@ -130,10 +190,7 @@ class OURateBuilder(BaseRateBuilder):
 
     @sigma.setter
     def sigma(self, sigma_):
-        if sigma_ > 0:
-            self._sigma = np.float64(sigma_)
-        else:
-            raise ValueError("'sigma' must have a positive non-zero value")
+        self._sigma = self._get_channel_param('sigma', sigma_, positive=True)
 
     @property
     def theta(self):
@@ -143,13 +200,14 @@ class OURateBuilder(BaseRateBuilder):
 
     @theta.setter
     def theta(self, theta_):
-        if theta_ > 0:
-            self._theta = np.float64(theta_)
-        else:
-            raise ValueError("'theta' must have a positive non-zero value")
+        self._theta = self._get_channel_param('theta', theta_, positive=True)
 
     @property
     def rng(self):
+        """
+        The random generator used for the build. Either a np.random.RandomState (the
+        default is the global numpy one) or a np.random.Generator
+        """
         return self._rng
 
     @rng.setter
@@ -158,6 +216,66 @@ class OURateBuilder(BaseRateBuilder):
         # used enough to bring out any type errors quickly enough
         self._rng = rng_
 
+    @property
+    def seed(self):
+        """
+        The seed of the per-channel streams, or None if rng is used. See class
+        documentation
+        """
+        return self._seed
+
+    @seed.setter
+    def seed(self, seed_):
+        if seed_ is None or int(seed_) >= 0:
+            self._seed = None if seed_ is None else int(seed_)
+        else:
+            raise ValueError("'seed' must be None or a non-negative integer")
+
+    @property
+    def dtype(self):
+        """
+        The floating point type of the generated rate array. Use np.float32 to halve the
+        memory footprint of large builds. Defaults to np.float64
+        """
+        return self._dtype
+
+    @dtype.setter
+    def dtype(self, dtype_):
+        dtype_ = np.dtype(dtype_)
+        if np.issubdtype(dtype_, np.floating):
+            self._dtype = dtype_
+        else:
+            raise ValueError("'dtype' must be a floating point type")
+
+    @property
+    def workers(self):
+        """
+        The number of processes used to build the rate array. See class documentation
+        """
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers_):
+        if workers_ >= 1:
+            self._workers = int(workers_)
+        else:
+            raise ValueError("'workers' must be a positive integer")
+
+    @property
+    def engine(self):
+        """
+        The engine used to generate the process, either 'scipy' or 'numba'. See class
+        documentation
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine_):
+        if engine_ in ('scipy', 'numba'):
+            self._engine = engine_
+        else:
+            raise ValueError("'engine' must be one of 'scipy' or 'numba'")
+
     @property
     def steps_per_ms(self):
         """
@@ -246,6 +364,18 @@ class OURateBuilder(BaseRateBuilder):
         """
         return self._rate_array
 
+    def _cache_params(self):
+        return dict(mean=self._mean, sigma=self._sigma, theta=self._theta,
+                    channels=self._channels, steps_per_ms=self._steps_per_ms, time_length=self._time_length,
+                    rng=(self._rng if self._seed is None else None), seed=self._seed,
+                    dtype=self._dtype, workers=self._workers, engine=self._engine)
+
+    def _get_cached_arrays(self):
+        return {'rate_array': self._rate_array}
+
+    def _set_cached_arrays(self, arrays):
+        self._rate_array = arrays['rate_array']
+
     def _build(self):
         """
         Does the actualwork of generating the OU Process from converted DT OU Parameters. This
@@ -261,35 +391,412 @@ class OURateBuilder(BaseRateBuilder):
 
         In order to remove initial transients we initialize the distribution across channels from
         the steady state distribution
+
+        See iter_chunks for generating the same process in bounded memory
+        """
+        self._stream_states = None
+        if self.cache is None:
+            self._build_rate_array()
+        else:
+            self.cache.cached_build(self, self._build_rate_array)
+
+    def _build_rate_array(self):
+        if self._workers > 1 and self._channels.size > 1:
+            self._rate_array = self._sharded_build()
+        else:
+            # Calculate Initial Condition from Steady state distribution of
+            # OU Process. This way we wont have to wait for the process to burn in
+            rng = self._get_block_rng(self._channels, 0)
+            filter_state = self._init_filter_state(self._DT_params, rng, self._channels.size)
+            self._rate_array, __ = self._filter_block(self._steps_length, filter_state, self._DT_params, rng)
+            self._stream_states = self._get_stream_states(rng)
+        self._rate_array.setflags(write=False)
+
+    def _sharded_build(self):
+        """
+        Builds the rate array by building copies of self restricted to contiguous shards
+        of the channels in a pool of processes (see parallel_tools)
         """
+        shard_bounds = get_shard_bounds(self._channels.size, self._workers)
+        if self._seed is None:
+            child_rngs = spawn_rngs(self._rng, len(shard_bounds))
+        else:
+            # The per-channel streams do not depend on rng
+            child_rngs = [self._rng]*len(shard_bounds)
+        shard_builders = []
+        row_orders = []
+        for (start, stop), child_rng in zip(shard_bounds, child_rngs):
+            shard_builder = self._get_shard_copy(start, stop)
+            shard_builder.rng = child_rng
+            shard_builder.workers = 1
+            shard_builder.cache = None
+            shard_builders.append(shard_builder)
+            row_orders.append(get_row_order(shard_builder.channels, self._channels[start:stop]))
+
+        return build_sharded_array(shard_builders, shard_bounds, row_orders,
+                                   shape=(self._channels.size, int(self._steps_length)),
+                                   dtype=self._dtype, workers=self._workers)
+
+    @requires_built
+    def extend(self, time_length):
+        """
+        Returns a built copy of self whose rate pattern is extended to the time length
+        time_length (>= the current time length) by continuing the process from its
+        current final state, so that only the new time steps are generated. The new steps are drawn from the current
+        state of the random generator, as a subsequent build would. If seed is
+        specified, the per-channel streams are continued past the draws of the existing
+        steps instead, so that the result is the same as that of a single build of the
+        extended time length (up to floating point rounding).
+
+        With the 'scipy' engine, the states of the streams are kept after each build and
+        extend in this process, so that they are continued directly. After a sharded or
+        cached build, the draws of the existing steps are repeated and discarded instead
+        (once, as the states are kept thereafter). The 'numba' engine reseeds every
+        NUMBA_SEED_BLOCK_STEPS steps, so that at-most that many draws are discarded.
+
+        self is not modified, so that this is safe for immutable builders (e.g. those
+        shared by a BuildMemo). This is a more efficient equivalent to build_copy() with
+        the new time_length (except that the existing steps are retained).
+
+        :returns: The extended copy
+        """
+        new_steps_length = np.uint32(time_length * self._steps_per_ms + 0.5)
+        if new_steps_length < self._steps_length:
+            raise ValueError("'time_length' must not be less than the current time length")
+
+        extended_builder = copy.deepcopy(self)
+        extended_builder._extend(time_length, new_steps_length)
+        return extended_builder
+
+    def _extend(self, time_length, new_steps_length):
+        nsteps = int(new_steps_length - self._steps_length)
+        if nsteps > 0:
+            DT_params = self._DT_params
+            skip_steps = 0
+            rng = self._get_block_rng(self._channels, 0)
+            if self._steps_length == 0:
+                filter_state = self._init_filter_state(DT_params, rng, self._channels.size)
+            else:
+                if self._stream_states is not None:
+                    rng.state_array = self._stream_states
+                elif self._seed is not None:
+                    # The draws of the initial state are discarded as well
+                    self._init_filter_state(DT_params, rng, self._channels.size)
+                    skip_steps = int(self._steps_length)
+                # The final state of the filter (see _build) is determined by the last
+                # step of the rate pattern
+                h = 1 / self._steps_per_ms
+                final_deviation = self._rate_array[:, -1:].astype(np.float64) - DT_params.mean
+                filter_state = ((1 - DT_params.theta * h) * final_deviation).astype(self._dtype)
+            new_rate_block, __ = self._filter_block(nsteps, filter_state, DT_params, rng, skip_steps)
+            self._stream_states = self._get_stream_states(rng)
+
+            rate_array = np.concatenate((self._rate_array, new_rate_block), axis=1)
+            rate_array.setflags(write=False)
+            self._rate_array = rate_array
+
+        self._time_length = np.float64(time_length)
+        self._steps_length = new_steps_length
+
+    @requires_built
+    def add_channels(self, channels, mean=None, sigma=None, theta=None):
+        """
+        Returns a built copy of self with the channels in channels (those already present
+        are ignored) added to the rate pattern, generating only the rows of the new
+        channels. The existing rows are retained, and the new rows are appended in
+        ascending order of channel. This
+        requires seed to be specified, so that each new channel is a realisation of its
+        own stream, identical to the one generated had the channel been present in the
+        build (or, if the builder has been extended, in a single build of its current
+        time length).
+
+        As with extend(), self is not modified.
+
+        :param mean, sigma, theta: The values of the per-channel parameters for the new
+            channels (scalar, or one per new channel in ascending order of channel). Must
+            be specified if and only if the corresponding parameter is per-channel
+
+        :returns: The copy with the added channels
+        """
+        if self._seed is None:
+            raise ValueError("Adding channels to a built OURateBuilder requires 'seed' to be specified")
+        new_channels = np.setdiff1d(np.array(list(set(channels)), dtype=np.int64), self._channels)
+        if new_channels.size == 0:
+            return copy.deepcopy(self)
+        if np.any(new_channels < 0):
+            raise ValueError("'channels' must be a vector of non-negative integers")
+        new_channels = new_channels.astype(np.uint32)
+
+        new_params = {}
+        for param_name, new_value in (('mean', mean), ('sigma', sigma), ('theta', theta)):
+            param = getattr(self, '_' + param_name)
+            if np.ndim(param) == 0:
+                if new_value is not None:
+                    raise ValueError("'{}' must not be specified as it is not per-channel".format(param_name))
+                new_params[param_name] = param
+            else:
+                if new_value is None:
+                    raise ValueError("'{}' must be specified as it is per-channel".format(param_name))
+                if np.size(new_value) not in (1, new_channels.size):
+                    raise ValueError("'{}' must be either a scalar or have one value per new channel"
+                                     .format(param_name))
+                new_value = np.broadcast_to(np.array(new_value, dtype=np.float64).reshape((-1, 1)),
+                                            (new_channels.size, 1))
+                if param_name != 'mean' and not np.all(new_value > 0):
+                    raise ValueError("'{}' must have positive non-zero values".format(param_name))
+                new_params[param_name] = new_value
+        new_DT_params = self._get_DT_params(**new_params)
+
+        new_builder = copy.deepcopy(self)
+        new_builder._add_channels(new_channels, new_params, new_DT_params)
+        return new_builder
+
+    def _add_channels(self, new_channels, new_params, new_DT_params):
+        rng = self._get_block_rng(new_channels, 0)
+        filter_state = self._init_filter_state(new_DT_params, rng, new_channels.size)
+        new_rate_rows, __ = self._filter_block(self._steps_length, filter_state, new_DT_params, rng)
+        if self._stream_states is not None:
+            self._stream_states = np.concatenate((self._stream_states, self._get_stream_states(rng)))
+            self._stream_states.setflags(write=False)
+
+        rate_array = np.concatenate((self._rate_array, new_rate_rows), axis=0)
+        rate_array.setflags(write=False)
+        self._rate_array = rate_array
+
+        channels = np.concatenate((self._channels, new_channels))
+        channels.setflags(write=False)
+        self._channels = channels
+
+        for param_name, new_value in new_params.items():
+            param = getattr(self, '_' + param_name)
+            if np.ndim(param) > 0:
+                param = np.concatenate((param, new_value))
+                param.setflags(write=False)
+                setattr(self, '_' + param_name, param)
+        self._DT_params = self.convert_params_CT_to_DT()
+
+    def iter_chunks(self, chunk_steps):
+        """
+        Generates the rate pattern as a sequence of time chunks instead of a single
+        array. The final filter state of each chunk is used as the initial condition
+        of the next, so the concatenation of the chunks is a realisation of the same
+        OU process as the one generated by build(), while the memory required is
+        bounded by that of a single chunk.
+
+        This does not build the builder, and the chunks are not stored. Every call
+        draws a fresh realisation from the random generator (unless seed is specified,
+        in which case every call generates the same realisation).
+
+        :param chunk_steps: The maximum number of time steps in each chunk. The last
+            chunk may be shorter
+
+        :returns: A generator yielding arrays of shape (len(channels), n) where n <=
+            chunk_steps. The chunks together span time_length
+        """
+        chunk_steps = int(chunk_steps)
+        if chunk_steps < 1:
+            raise ValueError("'chunk_steps' must be a positive integer")
+
+        steps_length = int(self._time_length * self._steps_per_ms + 0.5)
+        return self._generate_chunks(steps_length, chunk_steps, self.convert_params_CT_to_DT())
+
+    def build_trials(self, n):
+        """
+        Generates n independent realisations (trials) of the rate pattern in a single
+        vectorised pass over all the trials and channels. Like iter_chunks, this does
+        not build the builder. The trials are drawn from the random generator (or, if
+        seed is specified, from per-channel streams that also depend on the trial
+        index).
+
+        :returns: An array of shape (n, len(channels), steps) where trials[t] is the
+            rate array of the tth trial
+        """
+        n = int(n)
+        if n < 1:
+            raise ValueError("'n' must be a positive integer")
+
+        nchannels = self._channels.size
+        steps_length = int(self._time_length * self._steps_per_ms + 0.5)
+        # per-channel parameters are repeated for each trial
+        DT_params = self.convert_params_CT_to_DT()
+        DT_params = DT_param_struct(*[param if np.ndim(param) == 0 else np.tile(param, (n, 1))
+                                      for param in DT_params])
+        if self._seed is None:
+            rng = self._rng
+        else:
+            rng = ChannelRNGs(self._seed, self._channels, 0, trials=range(n))
+
+        filter_state = self._init_filter_state(DT_params, rng, n*nchannels)
+        rate_block, __ = self._filter_block(steps_length, filter_state, DT_params, rng)
+        return rate_block.reshape((n, nchannels, steps_length))
 
-        theta_DT = self._DT_params.theta
-        sigma_DT = self._DT_params.sigma
-        mean = self._DT_params.mean
+    def _generate_chunks(self, steps_length, chunk_steps, DT_params):
+        rng = self._get_block_rng(self._channels, 0)
+        filter_state = self._init_filter_state(DT_params, rng, self._channels.size)
+        for chunk_start in range(0, steps_length, chunk_steps):
+            nsteps = min(chunk_steps, steps_length - chunk_start)
+            rate_chunk, filter_state = self._filter_block(nsteps, filter_state, DT_params, rng)
+            yield rate_chunk
+
+    def _get_stream_states(self, rng):
+        """
+        Returns the state array of the per-channel streams rng to be kept for extend,
+        i.e. None unless seed is specified and the engine is 'scipy' (the 'numba' engine
+        continues the streams from their per-block seeds instead)
+        """
+        if self._seed is None or self._engine != 'scipy':
+            return None
+        return rng.state_array
+
+    def _get_block_rng(self, channels, start_step):
+        """
+        Returns the random generator used to generate the block of time starting at
+        start_step for the given channels, i.e. rng, or the per-channel streams if seed
+        is specified
+        """
+        if self._seed is None:
+            return self._rng
+        else:
+            return ChannelRNGs(self._seed, channels, start_step)
+
+    def _init_filter_state(self, DT_params, rng, nchannels):
+        """
+        Draws the initial state of the filter (one per channel) from the steady state
+        distribution of the OU Process
+        """
         h = 1 / self._steps_per_ms
+        # rd[0] = rc(0) = sigma^2/(2*theta) (see class documentation)
+        steady_state_SD = np.sqrt(DT_params.sigma**2 * h / (DT_params.theta * (2 - DT_params.theta * h)))
+        rate_array_init = rng.normal(loc=0, scale=steady_state_SD, size=(nchannels, 1))
+        return ((1 - DT_params.theta * h) * rate_array_init).astype(self._dtype)
 
-        # # Debug prints
-        # print("CT variance: {:<10.5f}".format(self._sigma**2/(2*self._theta)))
-        # print("DT variance: {:<10.5f}".format(sigma_DT**2*h/(theta_DT*(2 - theta_DT*h))))
-        # print()
-        # print("CT Mean: {:<10.5f}".format(self._mean))
-        # print("DT Mean: {:<10.5f}".format(mean))
-        # print()
-        # print("CT Corr: {:<10.5f}".format(np.exp(-self._theta*h)))
-        # print("DT Corr: {:<10.5f}".format(1 - theta_DT*h))
-        # print()
-
-        # Calculate Shape Vectors
-        curr_rate_array_shape = (self._channels.size, self._steps_length)
-
-        # Calculate Initial Condition from Steady state distribution of
-        # OU Process. This way we wont have to wait for the process to burn in
-        steady_state_SD = self._sigma / np.sqrt(2 * self._theta)
-        rate_array_init = self._rng.normal(loc=0, scale=steady_state_SD, size=(self._channels.size, 1))
-        filter_init_cond = (1 - theta_DT * h) * rate_array_init
-
-        awgn_array = self._rng.normal(size=curr_rate_array_shape)
-        filtered_awgn_array, __ = sg.lfilter([sigma_DT * h], [1, -(1 - theta_DT * h)], awgn_array, zi=filter_init_cond)
-
-        self._rate_array = filtered_awgn_array + mean
-        self._rate_array.setflags(write=False)
+    def _filter_block(self, nsteps, filter_state, DT_params, rng, skip_steps=0):
+        """
+        Generates the next nsteps time steps of the process starting from the filter
+        state filter_state (see _build for the filter used), for the channels
+        corresponding to the rows of filter_state. If skip_steps is non-zero, rng must be
+        the per-channel streams positioned at the first step, and the block starts at step
+        skip_steps of the streams (see extend).
+
+        :returns: (rate_block, final_filter_state)
+        """
+        h = 1 / self._steps_per_ms
+        dtype = self._dtype
+        nchannels = filter_state.shape[0]
+
+        # The filter coefficients (scalars or (channels, 1) arrays)
+        filter_pole = 1 - DT_params.theta * h
+        filter_gain = DT_params.sigma * h
+
+        if self._engine == 'numba':
+            rate_block = np.empty((nchannels, nsteps), dtype=dtype)
+            filter_state = np.array(filter_state, dtype=dtype)  # copy as it is updated in-place
+            # The seeds of all the blocks up to the last are drawn, as the seeds of the
+            # skipped blocks precede them in the streams
+            nseed_blocks = -(-(skip_steps + int(nsteps)) // NUMBA_SEED_BLOCK_STEPS)
+            seeds = draw_seeds(rng, (nchannels, nseed_blocks))[:, skip_steps // NUMBA_SEED_BLOCK_STEPS:]
+            OURateBuilder._numba_filter_block(rate_block, filter_state[:, 0], seeds,
+                                              self._get_channel_vector(filter_pole, nchannels),
+                                              self._get_channel_vector(filter_gain, nchannels),
+                                              self._get_channel_vector(DT_params.mean, nchannels),
+                                              skip_steps, NUMBA_SEED_BLOCK_STEPS)
+            return rate_block, filter_state
+
+        if skip_steps:
+            rng.discard_standard_normal(skip_steps, dtype)
+        awgn_array = std_normal(rng, (nchannels, int(nsteps)), dtype)
+        if np.ndim(filter_pole) == 0 and np.ndim(filter_gain) == 0:
+            # The filter coefficients are cast to dtype as lfilter computes in the
+            # widest type among its arguments
+            filter_b = np.array([filter_gain], dtype=dtype)
+            filter_a = np.array([1, -filter_pole], dtype=dtype)
+            rate_block, filter_state = sg.lfilter(filter_b, filter_a, awgn_array, zi=filter_state)
+            del awgn_array
+        else:
+            # The noise is scaled by the per-channel gain beforehand, and the channels are
+            # filtered in groups sharing the same pole, writing back into the noise array
+            awgn_array *= np.asarray(filter_gain, dtype=dtype)
+            channel_poles = np.broadcast_to(filter_pole, (nchannels, 1))[:, 0]
+            unique_poles, pole_inds = np.unique(channel_poles, return_inverse=True)
+            if unique_poles.size > MAX_LFILTER_GROUP_FRACTION * nchannels:
+                final_filter_state = np.array(filter_state, dtype=dtype)
+                OURateBuilder._numba_filter_rows(awgn_array, final_filter_state[:, 0],
+                                                 channel_poles.astype(dtype))
+            else:
+                # The rows of each group are contiguous in the stable ordering by group
+                filter_b = np.array([1], dtype=dtype)
+                final_filter_state = np.empty_like(filter_state)
+                group_order = np.argsort(pole_inds, kind='stable')
+                group_bounds = np.concatenate(([0], np.cumsum(np.bincount(pole_inds))))
+                for i, pole in enumerate(unique_poles):
+                    if unique_poles.size == 1:
+                        group_rows = slice(None)
+                    else:
+                        group_rows = group_order[group_bounds[i]:group_bounds[i + 1]]
+                    filter_a = np.array([1, -pole], dtype=dtype)
+                    awgn_array[group_rows], final_filter_state[group_rows] = sg.lfilter(
+                        filter_b, filter_a, awgn_array[group_rows], zi=filter_state[group_rows])
+            rate_block, filter_state = awgn_array, final_filter_state
+
+        # in-place to avoid allocating a third array of the same size
+        rate_block += np.asarray(DT_params.mean, dtype=dtype)
+        return rate_block, filter_state
+
+    @staticmethod
+    @jit(nopython=True, parallel=True, cache=True)
+    def _numba_filter_rows(block, filter_state, poles):
+        """
+        In-place equivalent of filtering each row c of block using lfilter with b = [1],
+        a = [1, -poles[c]] and zi = filter_state[c] (in parallel over the rows). The final
+        states are written back into filter_state. Used by the 'scipy' engine when the
+        channels share too few poles to be filtered in groups.
+        """
+        nchannels, nsteps = block.shape
+        for c in prange(nchannels):
+            z = filter_state[c]
+            pole = poles[c]
+            for i in range(nsteps):
+                y = block[c, i] + z
+                block[c, i] = y
+                z = pole * y
+            filter_state[c] = z
+
+    @staticmethod
+    @jit(nopython=True, parallel=True, cache=True)
+    def _numba_filter_block(rate_block, filter_state, seeds, a, b, mean, start_step, seed_block_steps):
+        """
+        Fused equivalent of the lfilter in _filter_block. For each channel c (in parallel),
+        the recursion
+
+            y[n] = z[n-1] + b[c]*w[n],  z[n] = a[c]*y[n]
+            rate_block[c, n] = y[n] + mean[c]
+
+        is run starting from z[-1] = filter_state[c] (i.e. the lfilter state convention).
+        The final z is written back into filter_state[c].
+
+        The block starts at the time step start_step of the process, which is divided in
+        blocks of seed_block_steps steps. The numba random generator is seeded with
+        seeds[c, k] at the start of the kth block overlapping rate_block (the draws of
+        the first block preceding start_step being discarded), so that the noise of each
+        step does not depend on the steps at which the process is split into blocks.
+        """
+        nchannels, nsteps = rate_block.shape
+        first_seed_block = start_step // seed_block_steps
+        for c in prange(nchannels):
+            z = filter_state[c]
+            a_c = a[c]
+            b_c = b[c]
+            mean_c = mean[c]
+            for i in range(nsteps):
+                step = start_step + i
+                if i == 0 or step % seed_block_steps == 0:
+                    np.random.seed(seeds[c, step // seed_block_steps - first_seed_block])
+                if i == 0:
+                    # The discarded draws are stored (and later overwritten) as otherwise
+                    # the draws are eliminated as dead code in parallel mode
+                    for k in range(step % seed_block_steps):
+                        rate_block[c, k % nsteps] = np.random.standard_normal()
+                y = z + b_c * np.random.standard_normal()
+                rate_block[c, i] = y + mean_c
+                z = a_c * y
+            filter_state[c] = z
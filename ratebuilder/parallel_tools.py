@@ -0,0 +1,131 @@
+# parallel_tools.py
+#
+#   Author: Arjun Rao
+#
+# This file contains functions used to build builders in a channel-sharded manner in a pool of
+# processes. The channels of a builder are split into contiguous shards, a copy of the builder
+# restricted to the channels of each shard (and with its own random generator) is built in a
+# worker process, and the results are assembled in the channel order of the original builder.
+
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# The RAM backed directory preferred for the files backing the assembled arrays (see
+# _get_shared_array_dir)
+_shm_dir = '/dev/shm'
+
+
+def get_shard_bounds(nchannels, nshards):
+    """
+    Splits range(nchannels) into (at-most) nshards contiguous non-empty shards of
+    (nearly) equal size
+
+    :returns: a list of (start, stop) tuples
+    """
+    nshards = max(1, min(nshards, nchannels))
+    bounds = np.linspace(0, nchannels, nshards + 1).astype(np.int64)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def get_row_order(built_channels, target_channels):
+    """
+    Returns the permutation perm such that built_channels[perm] == target_channels, or
+    None if the two are already in the same order. This is required as the channels
+    setters of the builders do not necessarily preserve the order of the channels
+    """
+    built_channels = np.asarray(built_channels)
+    target_channels = np.asarray(target_channels)
+    if np.array_equal(built_channels, target_channels):
+        return None
+    sorter = np.argsort(built_channels)
+    return sorter[np.searchsorted(built_channels, target_channels, sorter=sorter)]
+
+
+def _build_shard_into_file(shard_builder, file_path, shape, dtype, start, stop, row_order, array_property):
+    out_array = np.memmap(file_path, dtype=dtype, mode='r+', shape=shape)
+    shard_builder.build()
+    shard_array = getattr(shard_builder, array_property)
+    if row_order is not None:
+        shard_array = shard_array[row_order]
+    out_array[start:stop] = shard_array
+    del out_array, shard_array
+
+
+def _get_shared_array_dir(nbytes):
+    """
+    Returns the directory in which to create the file backing an assembled array of
+    nbytes bytes, i.e. /dev/shm if it exists and has enough free space, and the default
+    temporary directory otherwise. /dev/shm is often small (e.g. 64MB in containers),
+    and as the file is sparse, running out of space there would only surface as a
+    SIGBUS when the workers write into the map
+    """
+    if os.path.isdir(_shm_dir):
+        try:
+            shm_stats = os.statvfs(_shm_dir)
+        except OSError:
+            pass
+        else:
+            if shm_stats.f_bavail * shm_stats.f_frsize >= nbytes:
+                return _shm_dir
+    return tempfile.gettempdir()
+
+
+def build_sharded_array(shard_builders, shard_bounds, row_orders, shape, dtype, workers,
+                        array_property='rate_array', directory=None):
+    """
+    Builds each of the shard builders in a pool of workers processes. The array
+    property array_property of the ith shard builder (after reordering its rows via
+    row_orders[i]) is written directly into rows shard_bounds[i][0]:shard_bounds[i][1]
+    of an output array of the given shape and dtype
+
+    The output array is a shared memory map of a temporary file which is removed as
+    soon as it is mapped, so that the memory is freed when the array is deleted. The
+    result is thus assembled in place without being copied
+
+    :param directory: The directory of the temporary file. Defaults to /dev/shm if it
+        has enough free space for the array, and to the default temporary directory
+        otherwise
+
+    :returns: The assembled array
+    """
+    dtype = np.dtype(dtype)
+    if int(np.prod(shape)) == 0:
+        # empty files cannot be memory mapped (and there is nothing to build)
+        return np.zeros(shape, dtype=dtype)
+
+    if directory is None:
+        directory = _get_shared_array_dir(int(np.prod(shape)) * dtype.itemsize)
+    file_descriptor, file_path = tempfile.mkstemp(prefix='.shards-', suffix='.dat', dir=directory)
+    os.close(file_descriptor)
+    try:
+        out_array = np.memmap(file_path, dtype=dtype, mode='w+', shape=shape)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_build_shard_into_file, shard_builder, file_path, shape, dtype,
+                                       start, stop, row_order, array_property)
+                       for shard_builder, (start, stop), row_order in zip(shard_builders, shard_bounds, row_orders)]
+            for future in futures:
+                future.result()
+    finally:
+        os.remove(file_path)
+    # a plain ndarray view (which keeps the map alive)
+    return out_array.view(np.ndarray)
+
+
+def build_sharded(shard_builders, workers, result_func):
+    """
+    Builds each of the shard builders in a pool of workers processes and returns the
+    list of result_func(built_shard_builder) (which must be picklable, as must be
+    result_func), in the order of shard_builders
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_build_and_apply, shard_builder, result_func)
+                   for shard_builder in shard_builders]
+        return [future.result() for future in futures]
+
+
+def _build_and_apply(shard_builder, result_func):
+    shard_builder.build()
+    return result_func(shard_builder)
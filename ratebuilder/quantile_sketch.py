@@ -0,0 +1,163 @@
+# quantile_sketch.py
+#
+#   Author: Arjun Rao
+#
+# This file contains a fixed-size, mergeable summary of the distribution of a stream of values
+# (QuantileSketch), and the functions to perform histogram matching using such summaries
+# instead of the full (sorted) source and template arrays. This allows histogram matched rates
+# to be produced from chunk-streamed rate data (see e.g. OURateBuilder.iter_chunks).
+#
+# A typical streaming pipeline is
+#
+#     template_sketch = QuantileSketch()
+#     for chunk in template_chunks:
+#         template_sketch.update(chunk)
+#
+#     source_sketch = QuantileSketch()
+#     for chunk in source_chunks:
+#         source_sketch.update(chunk)
+#
+#     for chunk in source_chunks:   # second pass (e.g. regenerated with the same seed)
+#         matched_chunk = hist_match_sketch(chunk, source_sketch, template_sketch)
+
+import numpy as np
+
+
+class QuantileSketch:
+    """
+    A summary of the distribution of all the values it has been updated with, consisting
+    of at-most `size` weighted centroids (plus the exact minimum and maximum). The
+    centroids are the means of groups of (nearly) equal total weight of the sorted
+    values, so that the error in the estimated quantiles is of the order of 1/size
+    irrespective of the number of values summarised.
+
+    Sketches are mergeable, i.e. the sketch of the union of two datasets can be
+    computed from the sketches of each (see merge). Hence chunks can be summarised
+    independently (e.g. in different processes) and combined.
+    """
+
+    def __init__(self, size=1024):
+        if size < 2:
+            raise ValueError("'size' must be an integer >= 2")
+        self._size = int(size)
+        self._values = np.zeros(0, dtype=np.float64)
+        self._weights = np.zeros(0, dtype=np.float64)
+        self._min = np.inf
+        self._max = -np.inf
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def count(self):
+        """
+        The total number of values summarised
+        """
+        return np.sum(self._weights)
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def max(self):
+        return self._max
+
+    def update(self, data):
+        """
+        Adds the values in the array data (flattened) to the summary
+
+        :returns: self
+        """
+        data = np.asarray(data, dtype=np.float64).ravel()
+        if data.size:
+            self._min = min(self._min, np.amin(data))
+            self._max = max(self._max, np.amax(data))
+            self._compress(np.concatenate((self._values, data)),
+                           np.concatenate((self._weights, np.ones(data.size))))
+        return self
+
+    def merge(self, other):
+        """
+        Adds the values summarised by the QuantileSketch other to this summary
+
+        :returns: self
+        """
+        if other._weights.size:
+            self._min = min(self._min, other._min)
+            self._max = max(self._max, other._max)
+            self._compress(np.concatenate((self._values, other._values)),
+                           np.concatenate((self._weights, other._weights)))
+        return self
+
+    def _compress(self, values, weights):
+        sort_order = np.argsort(values, kind='stable')
+        values = values[sort_order]
+        weights = weights[sort_order]
+
+        if values.size <= self._size:
+            self._values = values
+            self._weights = weights
+            return
+
+        # Each value is assigned to the group containing the midpoint of its weight
+        cum_weights = np.cumsum(weights)
+        total_weight = cum_weights[-1]
+        group_inds = ((cum_weights - weights/2)/total_weight*self._size).astype(np.int64)
+        group_inds = np.minimum(group_inds, self._size - 1)
+
+        group_weights = np.bincount(group_inds, weights=weights, minlength=self._size)
+        group_sums = np.bincount(group_inds, weights=weights*values, minlength=self._size)
+        non_empty = group_weights > 0
+        self._values = group_sums[non_empty]/group_weights[non_empty]
+        self._weights = group_weights[non_empty]
+
+    def _get_cdf_table(self):
+        """
+        Returns the (values, probabilities) table representing the piecewise linear
+        estimate of the CDF. The centroids are placed at the midpoints of their weight
+        and the table is closed by the exact minimum and maximum
+        """
+        if not self._weights.size:
+            raise ValueError("The quantile sketch is empty")
+        cum_weights = np.cumsum(self._weights)
+        probs = (cum_weights - self._weights/2)/cum_weights[-1]
+        values = np.concatenate(([self._min], self._values, [self._max]))
+        probs = np.concatenate(([0.0], probs, [1.0]))
+        return values, probs
+
+    def quantile(self, probs):
+        """
+        Returns the estimated quantiles at the probabilities probs (array or scalar)
+        """
+        values, table_probs = self._get_cdf_table()
+        return np.interp(probs, table_probs, values)
+
+    def cdf(self, data):
+        """
+        Returns the estimated value of the CDF at each value of data (array or scalar)
+        """
+        values, table_probs = self._get_cdf_table()
+        return np.interp(data, values, table_probs)
+
+
+def hist_match_sketch(source, source_sketch, template_sketch, out=None):
+    """
+    Histogram matching based on quantile sketches. Maps each value in source to the
+    quantile of the template at the probability given by the CDF of the source, where
+    both are estimated by the respective QuantileSketch. source can be any chunk of the
+    data summarised by source_sketch.
+
+    :param out: Array of the shape of source into which the result is written (in its
+        dtype). If None, an array of the shape and floating point dtype of source is
+        returned
+
+    :returns: out
+    """
+    source = np.asarray(source)
+    if out is None:
+        out_dtype = source.dtype if np.issubdtype(source.dtype, np.floating) else np.float64
+        out = np.empty(source.shape, dtype=out_dtype)
+    out[...] = template_sketch.quantile(source_sketch.cdf(source.ravel())).reshape(source.shape)
+    return out
@@ -0,0 +1,281 @@
+# rng_tools.py
+#
+#   Author: Arjun Rao
+#
+# This file contains functions that deal with the random generators used by the builders. The
+# builders accept either a legacy np.random.RandomState (the default being the global numpy
+# one) or a np.random.Generator (e.g. backed by PCG64 or SFC64). These functions hide the
+# differences between the two.
+#
+# Builders that support per-channel deterministic streams (a `seed` parameter) use a
+# ChannelRNGs in place of the random generator, so that the realisation of each channel does not
+# depend on the other channels being generated.
+
+import numpy as np
+
+# The maximum number of samples drawn (per stream) in a single call by
+# ChannelRNGs.discard_standard_normal, and by std_normal when the samples are cast
+DRAW_BLOCK_SIZE = 2**20
+
+_UINT64_MASK = 2**64 - 1
+
+
+def std_normal(rng, size, dtype=np.float64):
+    """
+    Draws an array of standard normal samples of the given dtype from rng. A Generator
+    draws float32 samples natively, a RandomState draws float64 samples which are cast
+    to dtype in blocks of DRAW_BLOCK_SIZE samples, so that no float64 array of the full
+    size is allocated. The samples are the same as those of a single draw.
+    """
+    dtype = np.dtype(dtype)
+    if isinstance(rng, (np.random.Generator, ChannelRNGs)) and dtype in (np.float32, np.float64):
+        return rng.standard_normal(size=size, dtype=dtype)
+    elif dtype == np.float64:
+        return rng.standard_normal(size=size)
+    else:
+        out = np.empty(size, dtype=dtype)
+        out_flat = out.reshape(-1)
+        for block_start in range(0, out_flat.size, DRAW_BLOCK_SIZE):
+            block_stop = min(block_start + DRAW_BLOCK_SIZE, out_flat.size)
+            out_flat[block_start:block_stop] = rng.standard_normal(size=block_stop - block_start)
+        return out
+
+
+def spawn_rngs(rng, n):
+    """
+    Returns a list of n independent np.random.Generator objects derived from rng, one
+    for each constituent of a composite builder. rng can be any of the following
+
+    1.  A np.random.SeedSequence or an integer seed. The children are spawned from it
+        (or from np.random.SeedSequence(seed))
+
+    2.  A np.random.Generator. The children are spawned from the SeedSequence of its
+        bit generator, and use the same type of bit generator
+
+    3.  A np.random.RandomState. A SeedSequence is seeded with entropy drawn from it,
+        and the children are spawned from that
+
+    In all cases the children depend only on the state of rng and on their position,
+    so that they can be used in any order (or concurrently) with reproducible results.
+    Note that spawning advances the state of rng (or the spawn counter of the
+    SeedSequence) so that subsequent calls return new streams. This does not apply to
+    an integer seed, for which every call creates a new SeedSequence and hence returns
+    the same streams (the composite builders therefore keep the SeedSequence of an
+    integer seed instead).
+    """
+    bit_generator_type = np.random.PCG64
+    if isinstance(rng, np.random.SeedSequence):
+        seed_seq = rng
+    elif isinstance(rng, np.random.Generator):
+        bit_generator_type = type(rng.bit_generator)
+        seed_seq = getattr(rng.bit_generator, 'seed_seq', getattr(rng.bit_generator, '_seed_seq', None))
+        if not isinstance(seed_seq, np.random.SeedSequence):
+            # e.g. bit generators that were created from a state
+            seed_seq = np.random.SeedSequence(rng.integers(2**32, size=4, dtype=np.uint64))
+    elif isinstance(rng, np.random.RandomState):
+        seed_seq = np.random.SeedSequence(rng.randint(2**32, size=4, dtype=np.uint64))
+    else:
+        seed_seq = np.random.SeedSequence(rng)
+
+    return [np.random.Generator(bit_generator_type(child_seed_seq)) for child_seed_seq in seed_seq.spawn(n)]
+
+
+def set_builder_rng(builder, rng):
+    """
+    Makes the build of the (mutable) builder depend only on the np.random.Generator rng.
+    rng is assigned to the 'rng' property of builder (if it has one), and independent
+    Generators spawned from it are assigned to the builders it contains (e.g. the rate
+    builder of a RateBasedSpikeBuilder), recursively. Composite builders with an 'rng'
+    property (e.g. CombinedRateBuilder) spawn the generators of their constituents from
+    it themselves.
+    """
+    rate_builder = getattr(builder, 'rate_builder', None)
+    if rate_builder is not None:
+        rng, rate_builder_rng = spawn_rngs(rng, 2)
+        rate_builder = rate_builder.copy_mutable()
+        set_builder_rng(rate_builder, rate_builder_rng)
+        builder.rate_builder = rate_builder
+    if hasattr(builder, 'rng'):
+        builder.rng = rng
+
+
+def get_builder_rngs(value):
+    """
+    Returns the list of the random generators in value (e.g. a builder), including
+    those of the builders it contains, in the order in which they are keyed (see
+    build_cache.get_build_key)
+    """
+    if isinstance(value, (np.random.RandomState, np.random.Generator, np.random.SeedSequence)):
+        return [value]
+    elif isinstance(value, dict):
+        return [rng for item_key in sorted(value, key=repr) for rng in get_builder_rngs(value[item_key])]
+    elif isinstance(value, (tuple, list)):
+        return [rng for item in value for rng in get_builder_rngs(item)]
+    elif hasattr(value, '_cache_params'):
+        return get_builder_rngs(value._cache_params())
+    else:
+        return []
+
+
+def draw_seeds(rng, size):
+    """
+    Draws uint32 seeds from rng. These are used to seed the random generator of numba
+    kernels separately for each channel (numba maintains one generator per thread), so
+    that the kernel results are reproducible for a given state of rng irrespective of
+    the number of threads.
+    """
+    if isinstance(rng, (np.random.Generator, ChannelRNGs)):
+        return rng.integers(2**32, size=size, dtype=np.uint32)
+    else:
+        return rng.randint(2**32, size=size, dtype=np.uint32)
+
+
+class ChannelRNGs:
+    """
+    A set of independent np.random.Generator streams, one for each channel in channels,
+    where the stream of channel c depends only on (seed, c, start_step). It supports the
+    subset of the Generator interface used by the builders, and draws arrays of shape
+    (len(channels), ...) row by row, the ith row being drawn from the stream of
+    channels[i]. Parameters (loc, scale, lam) may be scalars or arrays that broadcast
+    against the drawn array.
+
+    :param start_step: The time step from which the generated block of time starts.
+        Blocks of time with different start steps use separate streams
+
+    :param trials: If specified, a sequence of trial indices. In this case there is a
+        row (stream) for every trial and channel, ordered by trial and then channel,
+        and the stream of trial t also depends on t
+    """
+
+    def __init__(self, seed, channels, start_step=0, trials=None):
+        channels = np.asarray(channels).ravel()
+        if trials is None:
+            spawn_keys = [(int(channel), int(start_step)) for channel in channels]
+        else:
+            spawn_keys = [(int(channel), int(start_step), int(trial)) for trial in trials for channel in channels]
+        self._rngs = [np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=spawn_key)))
+                      for spawn_key in spawn_keys]
+
+    def __len__(self):
+        return len(self._rngs)
+
+    @property
+    def state_array(self):
+        """
+        Get or set the states of the (PCG64) streams as a read-only uint64 array of shape
+        (len(self), 6), the ith row holding the 128-bit state and increment (high and low
+        words) and the buffered 32-bit output of the ith stream. This allows the streams
+        to be continued later (e.g. when extending a build) without repeating their draws,
+        and, being a read-only array, is shared rather than copied by builder copies
+        """
+        state_array = np.empty((len(self._rngs), 6), dtype=np.uint64)
+        for row, rng in zip(state_array, self._rngs):
+            bit_generator_state = rng.bit_generator.state
+            pcg_state = bit_generator_state['state']
+            row[:] = (pcg_state['state'] >> 64, pcg_state['state'] & _UINT64_MASK,
+                      pcg_state['inc'] >> 64, pcg_state['inc'] & _UINT64_MASK,
+                      bit_generator_state['has_uint32'], bit_generator_state['uinteger'])
+        state_array.setflags(write=False)
+        return state_array
+
+    @state_array.setter
+    def state_array(self, state_array_):
+        assert np.shape(state_array_) == (len(self._rngs), 6), "There must be one state per stream"
+        for row, rng in zip(state_array_.tolist(), self._rngs):
+            rng.bit_generator.state = {'bit_generator': 'PCG64',
+                                       'state': {'state': (row[0] << 64) | row[1], 'inc': (row[2] << 64) | row[3]},
+                                       'has_uint32': row[4], 'uinteger': row[5]}
+
+    def discard_standard_normal(self, nsamples, dtype=np.float64):
+        """
+        Advances every stream past nsamples standard normal samples of the given dtype,
+        i.e. as though standard_normal((len(self), nsamples), dtype) had been called. The
+        samples are drawn and discarded in blocks of at-most DRAW_BLOCK_SIZE samples
+        """
+        for rng in self._rngs:
+            for block_start in range(0, int(nsamples), DRAW_BLOCK_SIZE):
+                rng.standard_normal(size=min(DRAW_BLOCK_SIZE, int(nsamples) - block_start), dtype=dtype)
+
+    def _draw_rows(self, size, dtype, draw_func, *params):
+        size = tuple(np.atleast_1d(size))
+        assert size[0] == len(self._rngs), \
+            "The first dimension of the drawn array must be the number of channels"
+        params = [np.broadcast_to(param, size) for param in params]
+        out = np.empty(size, dtype=dtype)
+        for i, rng in enumerate(self._rngs):
+            out[i] = draw_func(rng, size[1:], *[param[i] for param in params])
+        return out
+
+    def standard_normal(self, size, dtype=np.float64):
+        return self._draw_rows(size, dtype, lambda rng, row_size: rng.standard_normal(size=row_size, dtype=dtype))
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        return self._draw_rows(size, np.float64, lambda rng, row_size, loc_, scale_: rng.normal(loc_, scale_),
+                               loc, scale)
+
+    def poisson(self, lam=1.0, size=None):
+        return self._draw_rows(size, np.int64, lambda rng, row_size, lam_: rng.poisson(lam_), lam)
+
+    def integers(self, high, size, dtype=np.int64):
+        return self._draw_rows(size, dtype, lambda rng, row_size: rng.integers(high, size=row_size, dtype=dtype))
+
+    def ragged_integers(self, high, counts, dtype=np.int64):
+        """
+        Returns the concatenation over the channels i of counts[i] integers in [0, high)
+        drawn from the stream of channels[i]
+        """
+        assert len(counts) == len(self._rngs), "There must be one count per channel"
+        row_arrays = [rng.integers(high, size=int(count), dtype=dtype)
+                      for rng, count in zip(self._rngs, counts) if count > 0]
+        return np.concatenate(row_arrays) if row_arrays else np.zeros(0, dtype=dtype)
+
+
+def draw_integers(rng, high, size):
+    """
+    Draws int64 integers in [0, high) from rng (a RandomState or a Generator)
+    """
+    if isinstance(rng, np.random.Generator):
+        return rng.integers(high, size=size, dtype=np.int64)
+    else:
+        return rng.randint(high, size=size, dtype=np.int64)
+
+
+def get_rng_state(rng):
+    """
+    Returns a picklable snapshot of the state of rng (RandomState, Generator or
+    SeedSequence), or None for any other object. For Generators and SeedSequences,
+    the number of children spawned from the SeedSequence is included (see
+    spawn_rngs) as it is not part of the state of the bit generator.
+    """
+    if isinstance(rng, np.random.RandomState):
+        return ('RandomState', rng.get_state())
+    elif isinstance(rng, np.random.Generator):
+        seed_seq = getattr(rng.bit_generator, 'seed_seq', getattr(rng.bit_generator, '_seed_seq', None))
+        n_children_spawned = getattr(seed_seq, 'n_children_spawned', 0)
+        return ('Generator', rng.bit_generator.state, n_children_spawned)
+    elif isinstance(rng, np.random.SeedSequence):
+        return ('SeedSequence', rng.entropy, rng.spawn_key, rng.pool_size, rng.n_children_spawned)
+    else:
+        return None
+
+
+def set_rng_state(rng, rng_state):
+    """
+    Sets the state of rng to the snapshot rng_state taken by get_rng_state. The
+    number of children spawned from a SeedSequence cannot be decreased, it is only
+    advanced (by spawning and discarding children) up to that of the snapshot.
+    """
+    if rng_state is None:
+        return
+    if rng_state[0] == 'RandomState':
+        rng.set_state(rng_state[1])
+        return
+    elif rng_state[0] == 'Generator':
+        rng.bit_generator.state = rng_state[1]
+        seed_seq = getattr(rng.bit_generator, 'seed_seq', getattr(rng.bit_generator, '_seed_seq', None))
+    else:
+        seed_seq = rng
+
+    n_children_spawned = getattr(seed_seq, 'n_children_spawned', None)
+    if n_children_spawned is not None and n_children_spawned < rng_state[-1]:
+        seed_seq.spawn(rng_state[-1] - n_children_spawned)
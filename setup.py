@@ -12,7 +12,7 @@ setup(
     description="This module provides the infrastructure to create custom (spike/rate) builders",
     license="MIT",
     keywords="Generic Builder builder generic",
-    install_requires=['genericbuilder>=2.0.0', 'numpy', 'scipy'],
+    install_requires=['genericbuilder>=2.0.0', 'numpy', 'scipy', 'numba'],
     provides=['ratebuilder', 'spikebuilder'],
     dependency_links=['git+https://github.com/maharjun/GenericBuilder.git@d9e9532#egg=genericbuilder-2.0.0']
 )
@@ -1,12 +1,29 @@
 __author__ = 'Arjun'
 
 import numpy as np
+from collections import namedtuple
 
 from genericbuilder.baseclass import BaseGenericBuilder
 from genericbuilder.propdecorators import requires_built
 
+from ratebuilder.copy_tools import deepcopy_sharing_readonly
+from .flat_spikes import spike_arrays_to_flat, flat_to_spike_arrays, flat_to_object_array
+
 from abc import abstractmethod
 
+SpikeFlatArrays = namedtuple('SpikeFlatArrays', ['indptr', 'rel_steps', 'weights'])
+
+
+class _DerivedSpikeArrays(dict):
+    """
+    The arrays derived (lazily) from the flat spike arrays of a built builder. This is
+    shared rather than copied between copies of the builder, as are the (read-only) flat
+    arrays it is derived from. A new one is created whenever the flat arrays are set.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
 
 class BaseSpikeBuilder(BaseGenericBuilder):
     """
@@ -26,17 +43,25 @@ class BaseSpikeBuilder(BaseGenericBuilder):
         SpikeBuilder, they will be derived properties of the rate generators/
         contained spike generators in many cases.
 
-    5.  The build_ function should set the following members
+    5.  The build_ function should set the built spikes in the flat (CSR) form
+        (indptr, rel_steps, weights) by calling
 
-            self._spike_rel_step_array
-            self._spike_weight_array
+            self._set_spike_flat_arrays(indptr, rel_steps, weights)
 
-        The following properties can be used to access these members
+        where the spikes of the ith channel are rel_steps[indptr[i]:indptr[i+1]] (and
+        similarly for weights). The following can be used to access them
 
+            spike_flat_arrays
+            get_channel_spikes
             spike_time_array
             spike_step_array
             spike_rel_step_array
             spike_weight_array
+
+        The object array properties (spike_rel_step_array, spike_weight_array) are
+        derived lazily from the flat arrays (the per-channel arrays being views into
+        them) for compatibility. Subclasses may instead override these two properties,
+        in which case the flat arrays are derived from them.
     """
 
     builder_type = 'spike'
@@ -112,9 +137,63 @@ class BaseSpikeBuilder(BaseGenericBuilder):
     #         else:
     #             raise ValueError("'channels' should be integers >= 0")
 
+    # ------------------------------------------------------------------------------------- #
+    # SPIKE STORAGE
+    # ------------------------------------------------------------------------------------- #
+
+    def _set_spike_flat_arrays(self, indptr, rel_steps, weights):
+        """
+        Sets the built spikes from the flat arrays (see spike_flat_arrays). The arrays
+        are made read-only. To be called by the _build of the subclass
+        """
+        indptr = np.asarray(indptr, dtype=np.int64)
+        for array in (indptr, rel_steps, weights):
+            array.setflags(write=False)
+        self._spike_flat_arrays = SpikeFlatArrays(indptr, rel_steps, weights)
+        self._derived_spike_arrays = _DerivedSpikeArrays()
+
+    @property
+    @requires_built
+    def spike_flat_arrays(self):
+        """
+        The built spikes in flat (CSR) form
+
+        :returns: a namedtuple (indptr, rel_steps, weights) of read-only 1-D arrays such
+            that the spikes of the ith channel (channels[i]) are at the time steps
+            (relative to the beginning of the spike pattern) rel_steps[indptr[i]:indptr[i+1]]
+            with the weights weights[indptr[i]:indptr[i+1]]
+        """
+        spike_flat_arrays = getattr(self, '_spike_flat_arrays', None)
+        if spike_flat_arrays is None:
+            # subclasses that override the object array properties instead
+            spike_flat_arrays = SpikeFlatArrays(*spike_arrays_to_flat(self.spike_rel_step_array,
+                                                                       self.spike_weight_array))
+        return spike_flat_arrays
+
+    @requires_built
+    def get_channel_spikes(self, i):
+        """
+        Returns the (zero-copy) views (rel_steps, weights) of the spikes of the ith
+        channel (channels[i]). See spike_flat_arrays
+        """
+        indptr, rel_steps, weights = self.spike_flat_arrays
+        return rel_steps[indptr[i]:indptr[i+1]], weights[indptr[i]:indptr[i+1]]
+
+    def _get_derived_spike_arrays(self, name, derive_func):
+        """
+        Returns the array name derived from the flat spike arrays, calling derive_func()
+        to derive it on first access (per build)
+        """
+        derived_spike_arrays = getattr(self, '_derived_spike_arrays', None)
+        if derived_spike_arrays is None:
+            # subclasses that override the object array properties are not cached
+            return derive_func()
+        if name not in derived_spike_arrays:
+            derived_spike_arrays[name] = derive_func()
+        return derived_spike_arrays[name]
+
     @property
     @requires_built
-    @abstractmethod
     def spike_rel_step_array(self):
         """
         Property that returns the relative spike step array.
@@ -124,14 +203,14 @@ class BaseSpikeBuilder(BaseGenericBuilder):
               A[i][j] = TIME STEP of the jth spike of the ith neuron relative to the
                         beginning of the spike pattern
 
-        NOTE: This is a core interface property that must be implemented (only the
-              getter) in the subclass spike builders.
+        NOTE: This is derived (once per build) from spike_flat_arrays. A[i] is a view
+              into spike_flat_arrays.rel_steps
         """
-        pass
+        return self._get_derived_spike_arrays('spike_object_arrays',
+                                              lambda: flat_to_spike_arrays(*self._spike_flat_arrays))[0]
 
     @property
     @requires_built
-    @abstractmethod
     def spike_weight_array(self):
         """
         Property that returns the spike weight array.
@@ -140,11 +219,55 @@ class BaseSpikeBuilder(BaseGenericBuilder):
 
               A[i][j] = WEIGHT of the jth spike of the ith neuron
 
-        NOTE: This is a core interface property that must be implemented (only the
-              getter) in the subclass spike builders.
+        NOTE: This is derived (once per build) from spike_flat_arrays. A[i] is a view
+              into spike_flat_arrays.weights
+        """
+        return self._get_derived_spike_arrays('spike_object_arrays',
+                                              lambda: flat_to_spike_arrays(*self._spike_flat_arrays))[1]
+
+    def __deepcopy__(self, memo):
         """
-        raise AttributeError(
-            "The property 'spike_weight_array' is not implemented in class '{}'".format(self.__class__.__name__))
+        Deep copies of builders share the read-only (built and parameter) arrays, the
+        random generators and the contained builders' data with the original (see
+        ratebuilder.copy_tools). As these arrays are never modified in-place, this is
+        effectively copy-on-write.
+        """
+        return deepcopy_sharing_readonly(self, memo)
+
+    # ------------------------------------------------------------------------------------- #
+    # BUILD CACHE INTERFACE
+    # ------------------------------------------------------------------------------------- #
+    #
+    # See ratebuilder.build_cache. Builders that support caching implement _cache_params,
+    # _get_cached_arrays and _set_cached_arrays, and pass their build through the cache.
+
+    @property
+    def cache(self):
+        """
+        The ratebuilder.build_cache.BuildCache used to store and retrieve the results of
+        builds. None (default) disables caching. It has no effect on builders that do
+        not support caching
+        """
+        return getattr(self, '_cache', None)
+
+    @cache.setter
+    def cache(self, cache_):
+        self._cache = cache_
+
+    def _cache_params(self):
+        """
+        Returns a dict of all the parameters (including the random generator) that
+        determine the result of a build. Used to key the build caches.
+        """
+        raise NotImplementedError(
+            "Builder class '{}' does not support caching".format(self.__class__.__name__))
+
+    def _get_cached_arrays(self):
+        indptr, rel_steps, weights = self._spike_flat_arrays
+        return {'spike_indptr': indptr, 'spike_steps': rel_steps, 'spike_weights': weights}
+
+    def _set_cached_arrays(self, arrays):
+        self._set_spike_flat_arrays(arrays['spike_indptr'], arrays['spike_steps'], arrays['spike_weights'])
 
     # ------------------------------------------------------------------------------------- #
     # MIXIN INTERFACE FEATURES
@@ -160,6 +283,45 @@ class BaseSpikeBuilder(BaseGenericBuilder):
         """
         return int(self.time_length * self.steps_per_ms + 0.5)
 
+    @requires_built
+    def spike_flat_steps(self, start_time=0):
+        """
+        Returns the time steps of all the spikes in the flat order of spike_flat_arrays,
+        offset as though the starting time step is
+
+            round(start_time*self.steps_per_ms)
+
+        The offset is applied to the whole flat array in a single operation (for a zero
+        offset, spike_flat_arrays.rel_steps is returned as is). The result is read-only
+        and is cached per starting time step (per build)
+
+        This is a mixin property that will function correctly if the core interface is
+        correcty implemented
+        """
+        start_time_step = int(start_time*self.steps_per_ms + 0.5)
+        return self._get_derived_spike_arrays(('spike_flat_steps', start_time_step),
+                                              lambda: _offset_flat_steps(self.spike_flat_arrays.rel_steps,
+                                                                         start_time_step))
+
+    @requires_built
+    def spike_flat_times(self, start_time=0):
+        """
+        Returns the times (in ms) of all the spikes in the flat order of
+        spike_flat_arrays assuming that start time is 'start_time' (see
+        spike_flat_steps). The result is read-only and is cached per starting time step
+        (per build)
+
+        This is a mixin property that will function correctly if the core interface is
+        correcty implemented
+        """
+        start_time_step = int(start_time*self.steps_per_ms + 0.5)
+        return self._get_derived_spike_arrays(('spike_flat_times', start_time_step),
+                                              lambda: self._get_flat_times(start_time))
+
+    def _get_flat_times(self, start_time):
+        flat_steps = self.spike_flat_steps(start_time)
+        return _as_readonly(flat_steps/self.steps_per_ms)
+
     @requires_built
     def spike_step_array(self, start_time):
         """
@@ -167,16 +329,16 @@ class BaseSpikeBuilder(BaseGenericBuilder):
 
             round(start_time*self.steps_per_ms)
 
+        The per-channel arrays are read-only views into spike_flat_steps(start_time),
+        and the result is cached per starting time step (per build)
+
         This is a mixin property that will function correctly if the core interface is
         correcty implemented
         """
         start_time_step = int(start_time*self.steps_per_ms + 0.5)
-        ret = np.ndarray(len(self.spike_rel_step_array), dtype=object)
-        for i in range(len(ret)):
-            ret[i] = self.spike_rel_step_array[i] + start_time_step
-            ret[i].setflags(write=False)
-        ret.setflags(write=False)
-        return ret
+        return self._get_derived_spike_arrays(('spike_step_array', start_time_step),
+                                              lambda: flat_to_object_array(self.spike_flat_arrays.indptr,
+                                                                           self.spike_flat_steps(start_time)))
 
     @requires_built
     def spike_time_array(self, start_time=0):
@@ -188,14 +350,127 @@ class BaseSpikeBuilder(BaseGenericBuilder):
               A[i][j] = TIME (not Time step) of the jth spike of the ith neuron
                         assuming that start time is 'start_time'
 
+        The per-channel arrays are read-only views into spike_flat_times(start_time),
+        and the result is cached per starting time step (per build)
+
         This is a mixin property that will function correctly if the core interface is
         correcty implemented
         """
-        steps_per_ms = self.steps_per_ms
-        start_time_step = int(start_time*steps_per_ms + 0.5)
-        ret = np.ndarray(len(self.spike_rel_step_array), dtype=object)
-        for i in range(len(ret)):
-            ret[i] = (self.spike_rel_step_array[i] + start_time_step)/steps_per_ms
-            ret[i].setflags(write=False)
-        ret.setflags(write=False)
-        return ret
+        start_time_step = int(start_time*self.steps_per_ms + 0.5)
+        return self._get_derived_spike_arrays(('spike_time_array', start_time_step),
+                                              lambda: flat_to_object_array(self.spike_flat_arrays.indptr,
+                                                                           self.spike_flat_times(start_time)))
+
+    # ------------------------------------------------------------------------------------- #
+    # EXPORT TO SIMULATOR INPUT FORMATS
+    # ------------------------------------------------------------------------------------- #
+    #
+    # These produce the inputs of the spike generators of the simulators directly from the
+    # flat spike arrays. The times and weights returned are (read-only) views of the
+    # cached flat arrays, i.e. only the sender ids are allocated.
+
+    def _get_neuron_ids(self, neuron_ids, default_ids):
+        """
+        Returns the array of neuron ids corresponding to the channels, given neuron_ids
+        as either None (default_ids are returned), a dict mapping each channel to its
+        id, or an array-like of ids in the order of channels
+        """
+        channels = self.channels
+        if neuron_ids is None:
+            return np.asarray(default_ids)
+        elif isinstance(neuron_ids, dict):
+            missing_channels = [channel for channel in channels.tolist() if channel not in neuron_ids]
+            if missing_channels:
+                raise ValueError("'neuron_ids' does not contain the ids of the channels {}".format(missing_channels))
+            return np.array([neuron_ids[channel] for channel in channels.tolist()])
+        else:
+            neuron_ids = np.asarray(neuron_ids)
+            if neuron_ids.shape != channels.shape:
+                raise ValueError("'neuron_ids' must contain one id for each channel (in the order of channels)")
+            return neuron_ids
+
+    @requires_built
+    def export_flat_spikes(self, start_time=0, neuron_ids=None):
+        """
+        Exports all the spikes as flat arrays in a single vectorised pass
+
+        :param start_time: The time (in ms) at which the spike pattern starts (see
+            spike_flat_times)
+
+        :param neuron_ids: The id of the sender of the spikes of each channel, either as
+            a dict mapping each channel to its id, or an array-like of ids in the order of
+            channels. By default the channels themselves
+
+        :returns: (senders, times, weights) 1-D arrays with one entry per spike, sorted by
+            sender (in the order of channels) and then by time. times (in ms) and weights
+            are read-only views of the cached flat arrays
+        """
+        indptr, __, weights = self.spike_flat_arrays
+        senders = np.repeat(self._get_neuron_ids(neuron_ids, self.channels), np.diff(indptr))
+        return senders, self.spike_flat_times(start_time), weights
+
+    @requires_built
+    def export_nest_spike_generators(self, start_time=0, neuron_ids=None):
+        """
+        Exports the spikes as the parameters of one NEST spike_generator per channel,
+        e.g. for use with
+
+            params = spike_builder.export_nest_spike_generators(start_time=1.0)
+            generators = nest.Create('spike_generator', len(params), params=list(params.values()))
+
+        Note that NEST requires the spike times to be on the grid of its resolution (i.e.
+        steps_per_ms must match it) and to be strictly positive, which may require a
+        non-zero start_time.
+
+        :param start_time: See export_flat_spikes
+
+        :param neuron_ids: See export_flat_spikes
+
+        :returns: A dict mapping the neuron id of each channel (in the order of channels)
+            to the dict {'spike_times': times, 'spike_multiplicities': weights} of its
+            spikes, where times (in ms) and weights are read-only views of the cached flat
+            arrays
+        """
+        neuron_ids = self._get_neuron_ids(neuron_ids, self.channels)
+        return {neuron_id: {'spike_times': channel_times, 'spike_multiplicities': channel_weights}
+                for neuron_id, channel_times, channel_weights in zip(neuron_ids.tolist(),
+                                                                     self.spike_time_array(start_time),
+                                                                     self.spike_weight_array)}
+
+    @requires_built
+    def export_brian2_spikes(self, start_time=0, neuron_ids=None):
+        """
+        Exports the spikes as the indices and times of a Brian2 SpikeGeneratorGroup, e.g.
+        for use with
+
+            indices, times = spike_builder.export_brian2_spikes()
+            group = SpikeGeneratorGroup(len(spike_builder.channels), indices, times*ms)
+
+        A SpikeGeneratorGroup cannot emit more than one spike of a neuron in a time step,
+        hence a ValueError is raised if any spike has a weight greater than 1.
+
+        :param start_time: See export_flat_spikes
+
+        :param neuron_ids: See export_flat_spikes. By default the index of each channel
+            in channels (i.e. the neuron index within the group)
+
+        :returns: (indices, times) 1-D arrays with one entry per spike (see
+            export_flat_spikes), times being in ms
+        """
+        indptr, __, weights = self.spike_flat_arrays
+        if weights.size and np.amax(weights) > 1:
+            raise ValueError("Brian2 SpikeGeneratorGroup does not support multiple spikes of a neuron in a time"
+                             " step (spikes with weight > 1)")
+        indices = np.repeat(self._get_neuron_ids(neuron_ids, np.arange(self.channels.size)), np.diff(indptr))
+        return indices, self.spike_flat_times(start_time)
+
+
+def _offset_flat_steps(rel_steps, start_time_step):
+    if start_time_step == 0:
+        return rel_steps
+    return _as_readonly(rel_steps + start_time_step)
+
+
+def _as_readonly(array):
+    array.setflags(write=False)
+    return array
@@ -1,6 +1,8 @@
 from . import BaseSpikeBuilder
-from genericbuilder.propdecorators import requires_built
 from genericbuilder.tools import get_builder_type
+from ratebuilder.rng_tools import spawn_rngs, set_builder_rng
+from ratebuilder.build_memo import memoised_build_copy
+from .flat_spikes import coo_to_flat
 
 import numpy as np
 
@@ -34,6 +36,20 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
         case. In this case, the spike builder will create an 'empty' spike train
         (i.e. by generating no spikes) for the excess duration
 
+    :param rng: If None (default), the constituent spike builders are built with
+        their own random generators, in the order of the repeat instances. If
+        specified (np.random.Generator, np.random.SeedSequence,
+        np.random.RandomState or int seed), an independent child Generator is
+        spawned from it for each repeat instance at each build, and assigned to the
+        'rng' property of the corresponding (copy of the) spike builder, with
+        independent generators spawned from it for the builders it contains, e.g.
+        its rate builder (see ratebuilder.rng_tools.set_builder_rng). The result
+        of each repeat instance then depends only on rng and its position, making
+        the builds order-independent and reproducible (see
+        ratebuilder.rng_tools.spawn_rngs). An int seed is converted to a
+        np.random.SeedSequence when assigned, so that each build spawns new
+        children (i.e. repeated builds give new realisations)
+
     Properties
     ==========
 
@@ -52,6 +68,9 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
       initialization function.  When getting it, a tuple of repeat_instances is
       returned
 
+    *rng*: The random generator from which the constituent generators are spawned
+      (see initialization)
+
     Non-Settable
     ------------
 
@@ -68,7 +87,7 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
       See BaseSpikeBuilder
     """
 
-    def __init__(self, spike_builder_list=[], repeat_instances_list=[], time_length='auto'):
+    def __init__(self, spike_builder_list=[], repeat_instances_list=[], time_length='auto', rng=None):
         # self._final_spike_builders_list = [] [Must be set in preprocess of derived class]
 
         # Filtering Input Dict
@@ -80,6 +99,7 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
         self.spike_builders = spike_builder_list
         self.repeat_instances = repeat_instances_list
         self.time_length = time_length
+        self.rng = rng
 
     def _get_time_length_from_ri(self, ri):
         if ri[2] is None:
@@ -89,10 +109,10 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
 
     def _preprocess(self):
         if self._spike_builders:
-            common_channels = set.union(*[set(sb.channels) for sb in self._spike_builders])
-            self._channels = np.array(sorted(common_channels), dtype=np.uint32)
+            common_channels = np.unique(np.concatenate([sb.channels for sb in self._spike_builders]))
+            self._channels = common_channels.astype(np.uint32)
         else:
-            self._channels = np.array(0, dtype=np.uint32)
+            self._channels = np.zeros(0, dtype=np.uint32)
 
         if self._time_length_is_derived:
             if self._spike_builders:
@@ -137,6 +157,16 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
             else:
                 raise ValueError("'time_length' must be a non-negative number")
 
+    @property
+    def rng(self):
+        return self._rng
+
+    @rng.setter
+    def rng(self, rng_):
+        # A SeedSequence is kept rather than the seed, as spawning from an int seed would
+        # create a new SeedSequence (and hence repeat the same children) at each build
+        self._rng = np.random.SeedSequence(rng_) if isinstance(rng_, (int, np.integer)) else rng_
+
     @property
     def spike_builders(self):
         return self._spike_builders
@@ -167,71 +197,54 @@ class CombinedSpikeBuilder(BaseSpikeBuilder):
                                  for ri in repeat_instances_list]
         self._repeat_instances = tuple(sorted(repeat_instances_list, key=lambda x: x[0:2]))
 
-    def _build(self):
+    def _cache_params(self):
+        return dict(spike_builders=self._spike_builders, repeat_instances=self._repeat_instances,
+                    time_length=('auto' if self._time_length_is_derived else self._time_length), rng=self._rng)
 
-        nchannels = self.channels.size
-        channel_index_map = dict(zip(self.channels, range(nchannels)))
+    def _build(self):
 
         # Performing Builds for each repeat instance. Note the builds are performed
         # sequentially. this means that if there is any state that is maintained after
         # each run, that state is incremented for each build of a particular generator
         # The self._spike_builders array is updated to reflect the new post-built
-        # generators
+        # generators. If self.rng is specified, each repeat instance is built with its
+        # own child generator instead
+        if self._rng is None:
+            child_rngs = [None]*len(self._repeat_instances)
+        else:
+            child_rngs = spawn_rngs(self._rng, len(self._repeat_instances))
+
         spike_builders_list = list(self._spike_builders)
         built_builders = []  # create one built copy of the builder for each repeat index
-        for start, index, stretch in self._repeat_instances:
+        for (start, index, stretch), child_rng in zip(self._repeat_instances, child_rngs):
             current_sb = spike_builders_list[index].copy_mutable()
             if stretch is not None:
                 current_sb.time_length = stretch
-            spike_builders_list[index] = current_sb.build().set_immutable()
+            if child_rng is not None:
+                set_builder_rng(current_sb, child_rng)
+            current_sb = memoised_build_copy(current_sb)
+            spike_builders_list[index] = current_sb
             built_builders.append(current_sb)
         self._spike_builders = tuple(spike_builders_list)
 
-        # Join the spike-steps and weights channel-wise across builders
-        spike_steps_clubbed = [[] for __ in self._channels]
-        spike_weights_clubbed = [[] for __ in self._channels]
-        for i, builder in enumerate(built_builders):
-            for (channel,
-                 channel_spike_step_array,
-                 channel_spike_weight_array) in zip(builder.channels,
-                                                    builder.spike_step_array(start_time=self._repeat_instances[i][0]),
-                                                    builder.spike_weight_array):
-
-                spike_steps_clubbed[channel_index_map[channel]].append(channel_spike_step_array)
-                spike_weights_clubbed[channel_index_map[channel]].append(channel_spike_weight_array)
-
-        # Concatenating arrays for each channel
-        spike_steps_joined = [np.concatenate(x) for x in spike_steps_clubbed]
-        spike_weights_joined = [np.concatenate(x) for x in spike_weights_clubbed]
-
-        # Grouping together the weights of the spikes that happen in a single time step
-        # and sorting the time step values
-        spike_steps_unique = [np.lib.arraysetops.unique(x) for x in spike_steps_joined]
-        spike_weights_joined = [np.bincount(step_inds, weights=weights)[step_inds_unique]
-                                for step_inds, step_inds_unique, weights in zip(spike_steps_joined,
-                                                                                spike_steps_unique,
-                                                                                spike_weights_joined)]
-        spike_steps_joined = spike_steps_unique
-
-        # Convert explicitly to read-only list-of-lists to avoid collapsing into 2-D lists
-        self._spike_rel_step_array = np.ndarray(len(spike_steps_joined), dtype=object)
-        self._spike_weight_array = np.ndarray(len(spike_weights_joined), dtype=object)
-
-        for i, (spike_rel_step, spike_weight) in enumerate(zip(spike_steps_joined, spike_weights_joined)):
-            self._spike_rel_step_array[i] = spike_rel_step
-            self._spike_weight_array[i] = spike_weight
-            self._spike_rel_step_array[i].setflags(write=False)
-            self._spike_weight_array[i].setflags(write=False)
-
-        self._spike_rel_step_array.setflags(write=False)
-        self._spike_weight_array.setflags(write=False)
-
-    @property
-    @requires_built
-    def spike_rel_step_array(self):
-        return self._spike_rel_step_array
-
-    @property
-    @requires_built
-    def spike_weight_array(self):
-        return self._spike_weight_array
+        # Join the spikes of all the builders as (channel index, step) pairs. The weights
+        # of the spikes that happen in the same channel and time step are summed, and the
+        # steps of each channel are sorted (see coo_to_flat)
+        spike_rows_list = []
+        spike_steps_list = []
+        spike_weights_list = []
+        for (start, __, __), builder in zip(self._repeat_instances, built_builders):
+            # self._channels is sorted (see _preprocess)
+            channel_index_array = np.searchsorted(self._channels, builder.channels)
+            indptr, __, weights = builder.spike_flat_arrays
+            spike_rows_list.append(np.repeat(channel_index_array, np.diff(indptr)))
+            spike_steps_list.append(builder.spike_flat_steps(start_time=start))
+            spike_weights_list.append(weights)
+
+        if built_builders:
+            self._set_spike_flat_arrays(*coo_to_flat(np.concatenate(spike_rows_list),
+                                                     np.concatenate(spike_steps_list),
+                                                     self._channels.size,
+                                                     weights=np.concatenate(spike_weights_list)))
+        else:
+            self._set_spike_flat_arrays(*coo_to_flat(np.zeros(0), np.zeros(0), self._channels.size))
@@ -1,9 +1,12 @@
 from . import BaseSpikeBuilder
 
 from genericbuilder.propdecorators import requires_built
+from .flat_spikes import dense_to_flat, coo_to_flat, concatenate_flat, select_flat_rows
+from ratebuilder.rng_tools import ChannelRNGs, draw_integers
 
 from numpy.random import mtrand
 import numpy as np
+import copy
 
 mtgen = mtrand.binomial.__self__
 
@@ -15,11 +18,28 @@ class ConstRateSpikeBuilder(BaseSpikeBuilder):
     =======================
 
     This is a spiek 
+
+    If seed (an integer) is specified, rng is not used and each channel is generated
+    from its own stream derived from (seed, channel) (see ratebuilder.rng_tools.ChannelRNGs),
+    so that channels can be added to a built builder via add_channels without
+    regenerating the existing ones.
+
+    The spikes are sampled by one of the following engines (the 'engine' parameter)
+
+    1.  'dense' (default) - Draws a Poisson spike count for every channel and time step
+        and extracts the non-zero entries. Costs O(channels x steps) time and memory
+
+    2.  'sparse' - Draws the total spike count of each channel (Poisson with mean
+        rate x time_length) and places the spikes uniformly at random over the time
+        steps, spikes falling on the same time step being merged into one spike of
+        higher weight. This has the same distribution as 'dense' (a Poisson process
+        conditioned on its count is uniformly distributed), but costs O(spikes) time
+        and memory, which is far cheaper for low rates and fine time resolutions
     """
 
     def __init__(self, rate,
                  channels=[], steps_per_ms=1, time_length=0,
-                 rng=mtgen):
+                 rng=mtgen, seed=None, engine='dense'):
 
         super().__init__()
 
@@ -28,6 +48,8 @@ class ConstRateSpikeBuilder(BaseSpikeBuilder):
         self.steps_per_ms = steps_per_ms
         self.time_length = time_length
         self.rng = rng
+        self.seed = seed
+        self.engine = engine
 
     def _validate(self):
         pass
@@ -83,31 +105,6 @@ class ConstRateSpikeBuilder(BaseSpikeBuilder):
         channels_unique_sorted.setflags(write=False)
         self._channels = channels_unique_sorted
 
-    @property
-    @requires_built
-    def spike_rel_step_array(self):
-        """
-        Property that returns the relative spike step array.
-
-        :returns: an array of arrays A such that::
-
-              A[i][j] = TIME STEP of the jth spike of the ith neuron relative to the
-                        beginning of the spike pattern
-        """
-        return self._spike_rel_step_array
-
-    @property
-    @requires_built
-    def spike_weight_array(self):
-        """
-        Property that returns the spike weight array.
-
-        :returns: an array of arrays A such that::
-
-              A[i][j] = WEIGHT of the jth spike of the ith neuron
-        """
-        return self._spike_weight_array
-
     @property
     def rate(self):
         return self._rate
@@ -137,18 +134,124 @@ class ConstRateSpikeBuilder(BaseSpikeBuilder):
     def rng(self, rng_):
         self._rng = rng_
 
+    @property
+    def seed(self):
+        """
+        The seed of the per-channel streams, or None if rng is used
+        """
+        return self._seed
+
+    @seed.setter
+    def seed(self, seed_):
+        assert seed_ is None or int(seed_) >= 0, "'seed' must be None or a non-negative integer"
+        self._seed = None if seed_ is None else int(seed_)
+
+    @property
+    def engine(self):
+        """
+        The engine used to sample the spikes, either 'dense' or 'sparse' (see class
+        documentation)
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine_):
+        assert engine_ in ('dense', 'sparse'), "'engine' must be one of 'dense' or 'sparse'"
+        self._engine = engine_
+
+    def _cache_params(self):
+        return dict(rate=self._rate, channels=self._channels, steps_per_ms=self._steps_per_ms,
+                    time_length=self._time_length, rng=(self._rng if self._seed is None else None),
+                    seed=self._seed, engine=self._engine)
+
     def _build(self):
         super()._build()
-        nchannels = self.channels.size
-        spike_weight_array = self._rng.poisson(lam=self.rate/(1000*self.steps_per_ms),
-                                               size=(nchannels, self.steps_length)).astype(np.uint32)
-        self._spike_rel_step_array = np.ndarray(nchannels, dtype=object)
-        self._spike_weight_array = np.ndarray(nchannels, dtype=object)
-
-        for i in range(nchannels):
-            self._spike_rel_step_array[i] = np.argwhere(spike_weight_array[i, :])[:, 0].astype(np.uint32)
-            self._spike_weight_array[i] = spike_weight_array[i, self._spike_rel_step_array[i]]
-            self._spike_rel_step_array[i].setflags(write=False)
-            self._spike_weight_array[i].setflags(write=False)
-        self._spike_rel_step_array.setflags(write=False)
-        self._spike_weight_array.setflags(write=False)
+        if self.cache is None:
+            self._build_spikes()
+        else:
+            self.cache.cached_build(self, self._build_spikes)
+
+    def _build_spikes(self):
+        rng = self._rng if self._seed is None else ChannelRNGs(self._seed, self._channels)
+        self._set_spike_flat_arrays(*self._sample_spikes(self._channels.size, self._rate, rng))
+
+    def _sample_spikes(self, nchannels, rate, rng):
+        """
+        :returns: the flat arrays (indptr, rel_steps, weights) of the sampled spikes
+        """
+        if self._engine == 'sparse':
+            return self._sample_spikes_sparse(nchannels, rate, rng)
+
+        spike_count_array = rng.poisson(lam=rate/(1000*self.steps_per_ms),
+                                        size=(nchannels, self.steps_length))
+        return dense_to_flat(spike_count_array)
+
+    def _sample_spikes_sparse(self, nchannels, rate, rng):
+        steps_length = self.steps_length
+        channel_rates = np.broadcast_to(rate, (nchannels, 1))[:, 0]
+        channel_spike_counts = rng.poisson(lam=channel_rates*steps_length/(1000*self.steps_per_ms), size=nchannels)
+        if isinstance(rng, ChannelRNGs):
+            spike_steps = rng.ragged_integers(steps_length, channel_spike_counts)
+        elif np.sum(channel_spike_counts) > 0:
+            spike_steps = draw_integers(rng, steps_length, np.sum(channel_spike_counts))
+        else:
+            spike_steps = np.zeros(0, dtype=np.int64)
+        spike_rows = np.repeat(np.arange(nchannels), channel_spike_counts)
+        return coo_to_flat(spike_rows, spike_steps, nchannels)
+
+    @requires_built
+    def add_channels(self, channels, rate=None):
+        """
+        Returns a built copy of self with the channels in channels (those already present
+        are ignored) added to the spike pattern, generating only the spikes of the new
+        channels. The spikes of the existing channels are retained. This requires seed to
+        be specified, so that the spikes of each new channel are identical to those
+        generated had the channel been present in the build.
+
+        self is not modified, so that this is safe for immutable builders (e.g. those
+        shared by a BuildMemo).
+
+        :param rate: The rates of the new channels (scalar, or one per new channel in
+            ascending order of channel). Must be specified if and only if the builder
+            has a per-channel rate
+
+        :returns: The copy with the added channels
+        """
+        assert self._seed is not None, \
+            "Adding channels to a built ConstRateSpikeBuilder requires 'seed' to be specified"
+        channels = (np.array(channels) + 0.5).astype(np.int32)  # 0.5 for rounding off
+        assert np.all(channels >= 0), "Channel indices should be non-negative integers"
+        new_channels = np.setdiff1d(channels, self._channels).astype(np.uint32)
+        if new_channels.size == 0:
+            return copy.deepcopy(self)
+
+        per_channel_rate = np.ndim(self._rate) > 0
+        assert (rate is not None) == per_channel_rate, \
+            "'rate' must be specified if and only if the builder has a per-channel rate"
+        if per_channel_rate:
+            assert np.size(rate) == 1 or np.size(rate) == new_channels.size, \
+                "'rate' must be either size 1 or the same size as the number of new channels"
+            new_rate = np.broadcast_to(np.array(rate, dtype=self._rate.dtype).reshape((-1, 1)),
+                                       (new_channels.size, 1))
+            assert np.all(new_rate >= 0), "'rate' must be a non-negative number"
+        else:
+            new_rate = self._rate
+
+        new_builder = copy.deepcopy(self)
+        new_builder._add_channels(new_channels, new_rate)
+        return new_builder
+
+    def _add_channels(self, new_channels, new_rate):
+        per_channel_rate = np.ndim(self._rate) > 0
+        new_spike_flat_arrays = self._sample_spikes(new_channels.size, new_rate, ChannelRNGs(self._seed, new_channels))
+
+        all_channels = np.concatenate((self._channels, new_channels))
+        channel_order = np.argsort(all_channels, kind='stable')
+        self._set_spike_flat_arrays(*select_flat_rows(
+            *concatenate_flat([self.spike_flat_arrays, new_spike_flat_arrays]), channel_order))
+
+        if per_channel_rate:
+            self._rate = np.concatenate((self._rate, new_rate))[channel_order]
+        channels = all_channels[channel_order]
+        channels.setflags(write=False)
+        self._channels = channels
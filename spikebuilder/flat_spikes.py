@@ -0,0 +1,144 @@
+# flat_spikes.py
+#
+#   Author: Arjun Rao
+#
+# This file contains the functions operating on spikes in flat (CSR) form, i.e. as the arrays
+# (indptr, steps, weights) such that the spikes of row (channel) i are at the time steps
+# steps[indptr[i]:indptr[i+1]] with the weights weights[indptr[i]:indptr[i+1]]. This is the
+# native built form of the spike builders (see BaseSpikeBuilder.spike_flat_arrays), in which
+# they are also cached (see ratebuilder.build_cache).
+
+import numpy as np
+
+
+def spike_arrays_to_flat(spike_rel_step_array, spike_weight_array):
+    """
+    Converts the per-channel spike step and weight arrays (object arrays of arrays)
+    into the flat arrays (indptr, steps, weights) such that the spikes of channel i are
+    steps[indptr[i]:indptr[i+1]] (and similarly for weights)
+    """
+    counts = np.array([channel_steps.size for channel_steps in spike_rel_step_array], dtype=np.int64)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    if len(spike_rel_step_array):
+        steps = np.concatenate(list(spike_rel_step_array))
+        weights = np.concatenate(list(spike_weight_array))
+    else:
+        steps = np.zeros(0, dtype=np.uint32)
+        weights = np.zeros(0, dtype=np.uint32)
+    return indptr, steps, weights
+
+
+def flat_to_spike_arrays(indptr, steps, weights):
+    """
+    Inverse of spike_arrays_to_flat. The per-channel arrays are read-only views into
+    steps and weights
+    """
+    return flat_to_object_array(indptr, steps), flat_to_object_array(indptr, weights)
+
+
+def flat_to_object_array(indptr, values):
+    """
+    Returns the read-only object array A of the read-only views A[i] =
+    values[indptr[i]:indptr[i+1]]
+    """
+    object_array = np.ndarray(indptr.size - 1, dtype=object)
+    for i in range(object_array.size):
+        object_array[i] = values[indptr[i]:indptr[i+1]]
+        object_array[i].setflags(write=False)
+    object_array.setflags(write=False)
+    return object_array
+
+
+def dense_to_flat(spike_count_array):
+    """
+    Converts a dense 2-D array of spike counts (rows x time steps) into the flat arrays
+    (indptr, steps, weights) (see spike_arrays_to_flat) of its non-zero entries, in a
+    single vectorised pass
+    """
+    rows, steps = np.nonzero(spike_count_array)
+    indptr = np.zeros(spike_count_array.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=spike_count_array.shape[0]), out=indptr[1:])
+    weights = spike_count_array[rows, steps].astype(np.uint32)
+    return indptr, steps.astype(np.uint32), weights
+
+
+def concatenate_flat(flat_arrays_list):
+    """
+    Concatenates the rows of the flat arrays (indptr, steps, weights) in
+    flat_arrays_list, i.e. the rows of the result are the rows of the first, followed by
+    those of the second and so on
+    """
+    indptr_list = [np.zeros(1, dtype=np.int64)]
+    offset = 0
+    for indptr, __, __ in flat_arrays_list:
+        indptr_list.append(np.asarray(indptr[1:], dtype=np.int64) + offset)
+        offset += int(indptr[-1])
+    indptr = np.concatenate(indptr_list)
+    if flat_arrays_list:
+        steps = np.concatenate([steps for __, steps, __ in flat_arrays_list])
+        weights = np.concatenate([weights for __, __, weights in flat_arrays_list])
+    else:
+        steps = np.zeros(0, dtype=np.uint32)
+        weights = np.zeros(0, dtype=np.uint32)
+    return indptr, steps, weights
+
+
+def select_flat_rows(indptr, steps, weights, rows):
+    """
+    Returns the flat arrays (indptr, steps, weights) consisting of the rows (an integer
+    index array) of the given flat arrays, in that order. The spikes are gathered in a
+    single vectorised pass
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    row_starts = np.asarray(indptr, dtype=np.int64)[rows]
+    row_counts = np.asarray(indptr, dtype=np.int64)[rows + 1] - row_starts
+    new_indptr = np.zeros(rows.size + 1, dtype=np.int64)
+    np.cumsum(row_counts, out=new_indptr[1:])
+    spike_inds = np.repeat(row_starts - new_indptr[:-1], row_counts) + np.arange(new_indptr[-1])
+    return new_indptr, steps[spike_inds], weights[spike_inds]
+
+
+def coo_to_flat(rows, steps, nrows, weights=None):
+    """
+    Converts spikes given as (row, step) pairs (in any order) with the given weights
+    (default 1 each) into the flat arrays (indptr, steps, weights) for nrows rows. The
+    weights of spikes with the same row and step are summed, and the steps of each row
+    are sorted. The resulting weights are uint32 if weights is None, otherwise of the
+    dtype of weights
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    steps = np.asarray(steps, dtype=np.int64)
+    step_stride = int(steps.max()) + 1 if steps.size else 1
+    unique_keys, spike_inverse = np.unique(rows*step_stride + steps, return_inverse=True)
+    if weights is None:
+        unique_weights = np.bincount(spike_inverse.ravel(), minlength=unique_keys.size).astype(np.uint32)
+    else:
+        unique_weights = np.bincount(spike_inverse.ravel(), weights=weights,
+                                     minlength=unique_keys.size).astype(np.asarray(weights).dtype)
+    unique_rows = unique_keys // step_stride
+
+    indptr = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(unique_rows, minlength=nrows), out=indptr[1:])
+    return indptr, (unique_keys - unique_rows*step_stride).astype(np.uint32), unique_weights
+
+
+def hstack_flat(flat_arrays_list):
+    """
+    Concatenates the flat arrays (indptr, steps, weights) in flat_arrays_list (which must
+    have the same number of rows) along time, i.e. row i of the result consists of the
+    spikes of row i of the first, followed by those of row i of the second and so on.
+    The spikes of each are moved directly to their final position (no sorting)
+    """
+    row_counts_list = [np.diff(np.asarray(indptr, dtype=np.int64)) for indptr, __, __ in flat_arrays_list]
+    indptr = np.zeros(row_counts_list[0].size + 1, dtype=np.int64)
+    np.cumsum(np.sum(row_counts_list, axis=0), out=indptr[1:])
+
+    steps = np.empty(indptr[-1], dtype=np.result_type(*[steps for __, steps, __ in flat_arrays_list]))
+    weights = np.empty(indptr[-1], dtype=np.result_type(*[weights for __, __, weights in flat_arrays_list]))
+    block_starts = indptr[:-1].copy()
+    for (part_indptr, part_steps, part_weights), row_counts in zip(flat_arrays_list, row_counts_list):
+        dest_inds = np.repeat(block_starts - part_indptr[:-1], row_counts) + np.arange(part_indptr[-1])
+        steps[dest_inds] = part_steps
+        weights[dest_inds] = part_weights
+        block_starts += row_counts
+    return indptr, steps, weights
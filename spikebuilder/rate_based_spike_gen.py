@@ -4,8 +4,12 @@ import numpy as np
 from numpy.random import mtrand
 
 from . import BaseSpikeBuilder
+from .flat_spikes import dense_to_flat, coo_to_flat, concatenate_flat, select_flat_rows, hstack_flat
 from genericbuilder.tools import get_builder_type
-from genericbuilder.propdecorators import requires_built
+from ratebuilder.rng_tools import spawn_rngs
+from ratebuilder.parallel_tools import get_shard_bounds, get_row_order, build_sharded
+from ratebuilder.build_cache import get_build_key
+from ratebuilder.build_memo import memoised_build_copy
 
 mtgen = mtrand.binomial.__self__
 
@@ -39,8 +43,44 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
           Start time for the Spike Pattern. Default: dt
 
         *rng*
-          The RandomSate object that is used for random generation. Defaults to numpy
-          default
+          The RandomState or np.random.Generator object that is used for random
+          generation. Defaults to numpy default
+
+        *workers*
+          The number of processes used for the build (default 1). If greater than 1,
+          the channels are split into `workers` shards. Each shard is built in a
+          separate process by a copy of this builder (with a copy of the rate builder)
+          restricted to the channels of the shard. The spike builder and rate builder
+          copies of each shard get their own random generators, spawned from rng (see
+          ratebuilder.rng_tools.spawn_rngs). The result is reproducible for a given
+          state of rng and number of workers. This requires the channels of the rate
+          builder to be settable. Note that in this case the rate builder is built
+          only in the worker processes, i.e. rate_builder remains unbuilt
+
+        *engine*
+          The method used to sample the spikes from the transformed rate array
+
+          1. 'dense' (default) - Draws a Poisson spike count for every channel and
+             time step, and extracts the non-zero entries
+
+          2. 'inversion' - Integrates the rate of each channel into its cumulative
+             intensity, draws the total spike count of each channel, and places the
+             spikes by inverting uniformly distributed arrivals against the cumulative
+             intensity (via a single searchsorted over all the channels). Spikes in the
+             same time step are merged into one spike of higher weight. This has the
+             same distribution as 'dense' but only generates the spikes that occur,
+             which is much cheaper for low rates and fine time resolutions. The
+             transformed rate array must be non-negative
+
+        *chunk_steps*
+          None (default) or a positive integer. If specified, the rate builder is not
+          built. Instead, chunks of (at-most) chunk_steps time steps are pulled from
+          its iter_chunks (supported by OURateBuilder, ConstRateBuilder and
+          CombinedRateBuilder), and each is transformed and converted to spikes before
+          the next is generated. The peak memory is thus that of a single chunk of rates
+          plus the (sparse) spikes. The transform is applied to each chunk separately,
+          and must hence act on each time step independently (e.g. np.copy, np.abs).
+          Like with workers > 1, rate_builder remains unbuilt
 
         Properties
         ==========
@@ -73,7 +113,7 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
         Other properties are documented in BaseSpikeBuilder
     """
 
-    def __init__(self, rate_builder, transform=np.copy, rng=mtgen):
+    def __init__(self, rate_builder, transform=np.copy, rng=mtgen, workers=1, engine='dense', chunk_steps=None):
 
         # default init of super and current class
         super().__init__()  # only purpose is to run BaseGenericBuilder init
@@ -84,13 +124,21 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
         self.rate_builder = rate_builder
         self.transform = transform
         self.rng = rng
+        self.workers = workers
+        self.engine = engine
+        self.chunk_steps = chunk_steps
 
     def _preprocess(self):
         # No preprocessing required for this class
         pass
 
     def _validate(self):
-        pass
+        if self._workers > 1:
+            assert type(self._rate_builder).channels.fset is not None, \
+                "Building with multiple workers requires a rate builder with settable channels"
+        if self._chunk_steps is not None:
+            assert hasattr(self._rate_builder, 'iter_chunks'), \
+                "Building in chunks requires a rate builder that supports iter_chunks"
 
     @property
     def rate_builder(self):
@@ -130,6 +178,39 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
     def rng(self, rng_):
         self._rng = rng_
 
+    @property
+    def workers(self):
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers_):
+        if workers_ >= 1:
+            self._workers = int(workers_)
+        else:
+            raise ValueError("'workers' must be a positive integer")
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine_):
+        if engine_ in ('dense', 'inversion'):
+            self._engine = engine_
+        else:
+            raise ValueError("'engine' must be one of 'dense' or 'inversion'")
+
+    @property
+    def chunk_steps(self):
+        return self._chunk_steps
+
+    @chunk_steps.setter
+    def chunk_steps(self, chunk_steps_):
+        if chunk_steps_ is None or chunk_steps_ >= 1:
+            self._chunk_steps = None if chunk_steps_ is None else int(chunk_steps_)
+        else:
+            raise ValueError("'chunk_steps' must be None or a positive integer")
+
     # Overriding Base Property Setters
     @property
     def steps_per_ms(self):
@@ -137,9 +218,7 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
 
     @steps_per_ms.setter
     def steps_per_ms(self, steps_per_ms_):
-        self._rate_builder = self._rate_builder.copy_mutable()
-        self._rate_builder.steps_per_ms = steps_per_ms_
-        self._rate_builder = self._rate_builder.set_immutable()
+        self._set_rate_builder_property('steps_per_ms', steps_per_ms_)
 
     @property
     def time_length(self):
@@ -147,9 +226,7 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
 
     @time_length.setter
     def time_length(self, time_length_):
-        self._rate_builder = self._rate_builder.copy_mutable()
-        self._rate_builder.time_length = time_length_
-        self._rate_builder = self._rate_builder.set_immutable()
+        self._set_rate_builder_property('time_length', time_length_)
 
     @property
     def channels(self):
@@ -157,53 +234,162 @@ class RateBasedSpikeBuilder(BaseSpikeBuilder):
 
     @channels.setter
     def channels(self, channels_):
-        self._rate_builder = self._rate_builder.copy_mutable()
-        self._rate_builder.channels = channels_
-        self._rate_builder = self._rate_builder.set_immutable()
-
-    @property
-    @requires_built
-    def spike_rel_step_array(self):
-        """
-        Property that returns the relative spike step array.
+        self._set_rate_builder_property('channels', channels_)
 
-        :returns: an array of arrays A such that::
+    def _set_rate_builder_property(self, name, value):
+        # The copy shares the (read-only) arrays of the rate builder, see BaseRateBuilder.__deepcopy__
+        rate_builder = self._rate_builder.copy_mutable()
+        setattr(rate_builder, name, value)
+        self._rate_builder = rate_builder.set_immutable()
 
-              A[i][j] = TIME STEP of the jth spike of the ith neuron relative to the
-                        beginning of the spike pattern
-        """
-        return self._spike_rel_step_array
+    def _cache_params(self):
+        return dict(rate_builder=self._rate_builder, transform=self._transform, rng=self._rng,
+                    workers=self._workers, engine=self._engine, chunk_steps=self._chunk_steps)
 
-    @property
-    @requires_built
-    def spike_weight_array(self):
-        """
-        Property that returns the spike weight array.
+    def _build(self):
+        # The key is computed before the rate builder is built as the build changes the
+        # state of its random generator (which may be shared with self.rng). Only the
+        # sampling of the spikes is cached, the rate builder is built (or retrieved from
+        # its own cache) as usual. When the rates are drawn in chunks, the rate builder
+        # is not built, and a cache hit restores the state of its random generator as
+        # well (see BuildCache.cached_build)
+        cache_key = None if self.cache is None else get_build_key(self)
+
+        if self._workers > 1 and self.channels.size > 1:
+            build_func = self._sharded_build
+        elif self._chunk_steps is not None:
+            build_func = self._sample_spikes_chunked
+        else:
+            self._rate_builder = memoised_build_copy(self._rate_builder)
+            build_func = self._sample_spikes
 
-        :returns: an array of arrays A such that::
+        if self.cache is None:
+            build_func()
+        else:
+            self.cache.cached_build(self, build_func, key=cache_key)
+
+    def _sample_spikes(self):
+        self._set_spike_flat_arrays(*self._sample_flat(self._transform(self._rate_builder.rate_array)))
+
+    def _sample_spikes_chunked(self):
+        chunk_flat_arrays_list = []
+        chunk_start = 0
+        for rate_chunk in self._rate_builder.iter_chunks(self._chunk_steps):
+            indptr, rel_steps, weights = self._sample_flat(self._transform(rate_chunk))
+            chunk_flat_arrays_list.append((indptr, rel_steps + np.uint32(chunk_start), weights))
+            chunk_start += rate_chunk.shape[1]
+            del rate_chunk
+
+        if chunk_flat_arrays_list:
+            self._set_spike_flat_arrays(*hstack_flat(chunk_flat_arrays_list))
+        else:
+            self._set_spike_flat_arrays(*coo_to_flat(np.zeros(0), np.zeros(0), self.channels.size))
 
-              A[i][j] = WEIGHT of the jth spike of the ith neuron
+    def _sample_flat(self, rate_array):
         """
-        return self._spike_weight_array
-
-    def _build(self):
-
-        self._rate_builder = self._rate_builder.build_copy()
+        Samples the spikes for the (transformed) 2-D rate_array using the engine
 
-        nchannels = self.channels.size
-        array_shape = (nchannels, self.steps_length)
-        poisson_distrib_spikes_from_rate = self._rng.poisson(
-            lam=self._transform(self._rate_builder.rate_array)/(1000*self.steps_per_ms),
-            size=array_shape)
+        :returns: the flat arrays (indptr, rel_steps, weights) of the spikes of each row
+        """
+        if self._engine == 'inversion':
+            return self._sample_flat_inversion(rate_array)
+
+        poisson_distrib_spikes_from_rate = self._rng.poisson(lam=rate_array/(1000*self.steps_per_ms),
+                                                             size=rate_array.shape)
+        return dense_to_flat(poisson_distrib_spikes_from_rate)
+
+    def _sample_flat_inversion(self, rate_array):
+        nrows, steps_length = rate_array.shape
+        if rate_array.size and np.amin(rate_array) < 0:
+            raise ValueError("The transformed rate array must be non-negative for the 'inversion' engine")
+        if steps_length == 0:
+            return coo_to_flat(np.zeros(0), np.zeros(0), nrows)
+
+        # The cumulative intensity (expected number of spikes) is computed over the
+        # flattened array, so that it is non-decreasing across all the rows, and the
+        # arrivals of all the rows can be inverted by a single searchsorted
+        cum_intensity = np.multiply(rate_array, 1/(1000*self.steps_per_ms), dtype=np.float64)
+        cum_intensity = cum_intensity.ravel()
+        np.cumsum(cum_intensity, out=cum_intensity)
+
+        row_ends = cum_intensity[steps_length - 1::steps_length]
+        row_starts = np.concatenate(([0.0], row_ends[:-1]))
+        row_totals = np.maximum(row_ends - row_starts, 0)
+
+        spike_rows = np.repeat(np.arange(nrows), self._rng.poisson(lam=row_totals, size=nrows))
+        spike_arrivals = row_starts[spike_rows] + self._rng.uniform(size=spike_rows.size)*row_totals[spike_rows]
+        flat_spike_inds = np.searchsorted(cum_intensity, spike_arrivals, side='right')
+        del cum_intensity, spike_arrivals
+
+        # guards against arrivals that round onto the boundary between rows
+        row_offsets = spike_rows*steps_length
+        spike_steps = np.clip(flat_spike_inds - row_offsets, 0, steps_length - 1)
+        return coo_to_flat(spike_rows, spike_steps, nrows)
+
+    def build_trials(self, n):
+        """
+        Generates the spikes of n independent trials in a single vectorised pass (using
+        the engine). If
+        the rate builder supports build_trials (e.g. OURateBuilder), the rates of all
+        the trials are generated in one pass as well, otherwise the rate builder is
+        built once for each trial. This does not build the builder.
+
+        :returns: The flat arrays (indptr, steps, weights) such that the spikes of
+            channel self.channels[i] in trial t are steps[indptr[t*C + i]:indptr[t*C + i + 1]]
+            (and similarly for weights), where C = len(self.channels). Hence the spikes
+            of trial t span indptr[t*C] to indptr[(t+1)*C]
+        """
+        n = int(n)
+        if n < 1:
+            raise ValueError("'n' must be a positive integer")
 
-        self._spike_rel_step_array = np.ndarray((nchannels,), dtype=object)
-        self._spike_weight_array = np.ndarray((nchannels,), dtype=object)
+        if hasattr(self._rate_builder, 'build_trials'):
+            trial_rate_array = self._rate_builder.build_trials(n)
+        else:
+            rate_builder = self._rate_builder.copy_mutable()
+            trial_rate_array = np.stack([memoised_build_copy(rate_builder).rate_array for __ in range(n)])
 
-        for i in range(nchannels):
-            non_zero_spike_inds = np.argwhere(poisson_distrib_spikes_from_rate[i, :] > 0)[:, 0]
-            self._spike_rel_step_array[i] = non_zero_spike_inds.astype(np.uint32)
-            self._spike_weight_array[i] = poisson_distrib_spikes_from_rate[i, non_zero_spike_inds].astype(np.uint32)
-            assert self._spike_rel_step_array[i].shape == self._spike_weight_array[i].shape
+        # transform is applied to a 2-D (trials*channels, steps) array as it is to rate_array
+        ntrials, nchannels, steps_length = trial_rate_array.shape
+        trial_rate_array = self._transform(trial_rate_array.reshape((ntrials*nchannels, steps_length)))
+        return self._sample_flat(trial_rate_array)
 
-        self._spike_rel_step_array.setflags(write=False)
-        self._spike_weight_array.setflags(write=False)
+    def _sharded_build(self):
+        """
+        Builds the spikes by building copies of self restricted to contiguous shards of
+        the channels in a pool of processes (see ratebuilder.parallel_tools)
+        """
+        channels = self.channels
+        shard_bounds = get_shard_bounds(channels.size, self._workers)
+        child_rngs = spawn_rngs(self._rng, 2*len(shard_bounds))
+
+        shard_builders = []
+        for i, (start, stop) in enumerate(shard_bounds):
+            # restricts the per-channel parameters of the rate builder to the shard as well
+            shard_rate_builder = self._rate_builder._get_shard_copy(start, stop)
+            if hasattr(shard_rate_builder, 'rng'):
+                shard_rate_builder.rng = child_rngs[2*i + 1]
+            if hasattr(shard_rate_builder, 'workers'):
+                shard_rate_builder.workers = 1
+            shard_rate_builder.cache = None
+
+            shard_builder = self.copy_mutable()
+            shard_builder.rate_builder = shard_rate_builder
+            shard_builder.rng = child_rngs[2*i]
+            shard_builder.workers = 1
+            shard_builder.cache = None
+            shard_builders.append(shard_builder)
+
+        shard_results = build_sharded(shard_builders, self._workers, _get_spike_arrays)
+
+        shard_flat_arrays_list = []
+        for (start, stop), (shard_channels, shard_flat_arrays) in zip(shard_bounds, shard_results):
+            row_order = get_row_order(shard_channels, channels[start:stop])
+            if row_order is not None:
+                shard_flat_arrays = select_flat_rows(*shard_flat_arrays, row_order)
+            shard_flat_arrays_list.append(shard_flat_arrays)
+        self._set_spike_flat_arrays(*concatenate_flat(shard_flat_arrays_list))
+
+
+def _get_spike_arrays(spike_builder):
+    return spike_builder.channels, tuple(spike_builder.spike_flat_arrays)
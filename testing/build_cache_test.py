@@ -0,0 +1,169 @@
+from ratebuilder import OURateBuilder
+from ratebuilder.build_cache import BuildCache, get_build_key
+from ratebuilder.build_memo import BuildMemo
+from spikebuilder import RateBasedSpikeBuilder
+
+import functools
+import tempfile
+import numpy as np
+import ipdb
+
+
+SCALE = 2
+
+
+def make_scaling_transform(factor):
+    return lambda rate_array: rate_array*factor
+
+
+def scale_by_global(rate_array):
+    return rate_array*SCALE
+
+
+def call_helper(rate_array):
+    return scale_by_global(rate_array)
+
+
+class SelfReferencingTransform:
+    def __init__(self, factor):
+        self.factor = factor
+        self.me = self
+
+    def __call__(self, rate_array):
+        return rate_array*self.factor
+
+
+def test1():
+    """
+    TEST:
+    Builders that differ only in their transform must have different build keys,
+    irrespective of whether the transforms are lambdas, closures or partials, whereas
+    builders with equal transforms must have equal keys
+    """
+    ou_rate_builder = OURateBuilder(mean=20, sigma=2, theta=1, channels=range(10), time_length=100, seed=4)
+
+    def get_key(transform):
+        return get_build_key(RateBasedSpikeBuilder(ou_rate_builder, transform=transform, rng=None))
+
+    assert get_key(lambda rate_array: rate_array*2) != get_key(lambda rate_array: rate_array + 2), \
+        "Different lambdas have the same key"
+    assert get_key(lambda rate_array: rate_array*2) == get_key(lambda rate_array: rate_array*2), \
+        "Equal lambdas have different keys"
+    assert get_key(make_scaling_transform(2)) != get_key(make_scaling_transform(3)), \
+        "Closures with different captured values have the same key"
+    assert get_key(make_scaling_transform(2)) == get_key(make_scaling_transform(2)), \
+        "Closures with equal captured values have different keys"
+    clip_key_10 = get_key(functools.partial(np.clip, a_min=0, a_max=10))
+    clip_key_20 = get_key(functools.partial(np.clip, a_min=0, a_max=20))
+    assert clip_key_10 != clip_key_20, \
+        "Different partials have the same key"
+    print("The build keys distinguish the transforms")
+
+
+def test2():
+    """
+    TEST:
+    A memo hit must return a builder holding the random generators of the builder
+    being built (including that of its rate builder), with these generators advanced
+    exactly as by the memoised build
+    """
+    build_memo = BuildMemo(max_bytes=2**24)
+
+    def get_spike_builder():
+        ou_rate_builder = OURateBuilder(mean=20, sigma=2, theta=1, channels=range(10), time_length=1000,
+                                        rng=np.random.default_rng(0))
+        return RateBasedSpikeBuilder(ou_rate_builder, rng=np.random.default_rng(1))
+
+    spike_builder1 = get_spike_builder()
+    spike_builder2 = get_spike_builder()
+    built_builder1 = build_memo.build_copy(spike_builder1)
+    built_builder2 = build_memo.build_copy(spike_builder2)
+
+    assert built_builder2.rng is spike_builder2.rng, "The memoised builder holds a foreign generator"
+    assert built_builder2.rate_builder.rng is spike_builder2.rate_builder.rng, \
+        "The memoised rate builder holds a foreign generator"
+    assert spike_builder1.rng.bit_generator.state == spike_builder2.rng.bit_generator.state, \
+        "The generator was not advanced as by the build"
+    assert all(np.array_equal(x, y) for x, y in zip(built_builder1.spike_flat_arrays, built_builder2.spike_flat_arrays))
+    print("The memo hit is equivalent to a build")
+
+
+def test3():
+    """
+    TEST:
+    The build key of a transform must depend on the values of the globals it reads,
+    including those read by the helper functions it calls. Transforms with cyclic
+    references must have a key (rather than exceeding the recursion limit)
+    """
+    global SCALE
+    ou_rate_builder = OURateBuilder(mean=20, sigma=2, theta=1, channels=range(10), time_length=100, seed=4)
+
+    def get_key(transform):
+        return get_build_key(RateBasedSpikeBuilder(ou_rate_builder, transform=transform, rng=None))
+
+    SCALE = 2
+    keys_2 = [get_key(lambda rate_array: rate_array*SCALE), get_key(scale_by_global), get_key(call_helper)]
+    SCALE = 3
+    keys_3 = [get_key(lambda rate_array: rate_array*SCALE), get_key(scale_by_global), get_key(call_helper)]
+    SCALE = 2
+    assert all(key_2 != key_3 for key_2, key_3 in zip(keys_2, keys_3)), \
+        "Transforms reading different values of a global have the same key"
+    assert get_key(call_helper) == keys_2[2], "Equal globals give different keys"
+
+    assert get_key(SelfReferencingTransform(2)) == get_key(SelfReferencingTransform(2)), \
+        "Equal cyclic transforms have different keys"
+    assert get_key(SelfReferencingTransform(2)) != get_key(SelfReferencingTransform(3)), \
+        "Different cyclic transforms have the same key"
+    print("The build keys depend on the globals read by the transforms, and handle cycles")
+
+
+def test4():
+    """
+    TEST:
+    A cache hit of a spike builder that draws the rates in chunks must advance the
+    random generator of its rate builder (which is not built) as the cache miss did,
+    and give the same spikes
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        build_cache = BuildCache(cache_dir)
+
+        def build_spike_builder():
+            ou_rate_builder = OURateBuilder(mean=20, sigma=2, theta=1, channels=range(10), time_length=1000,
+                                            rng=np.random.default_rng(0))
+            spike_builder = RateBasedSpikeBuilder(ou_rate_builder, rng=np.random.default_rng(1), chunk_steps=300)
+            spike_builder.cache = build_cache
+            return spike_builder.build()
+
+        missed_builder = build_spike_builder()
+        hit_builder = build_spike_builder()
+        assert len(build_cache._get_entry_names()) == 1, "The second build was not a cache hit"
+        hit_rate_builder, missed_rate_builder = hit_builder.rate_builder, missed_builder.rate_builder
+        assert hit_rate_builder.rng.bit_generator.state == missed_rate_builder.rng.bit_generator.state, \
+            "The cache hit did not advance the generator of the rate builder as the build"
+        assert hit_builder.rng.bit_generator.state == missed_builder.rng.bit_generator.state, \
+            "The cache hit did not advance the generator as the build"
+        assert all(np.array_equal(x, y)
+                   for x, y in zip(hit_builder.spike_flat_arrays, missed_builder.spike_flat_arrays))
+    print("The chunked cache hit is equivalent to a build")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        print("Starting Test 1")
+        test1()
+        print("Completed Test 1")
+        print("")
+
+        print("Starting Test 2")
+        test2()
+        print("Completed Test 2")
+        print("")
+
+        print("Starting Test 3")
+        test3()
+        print("Completed Test 3")
+        print("")
+
+        print("Starting Test 4")
+        test4()
+        print("Completed Test 4")
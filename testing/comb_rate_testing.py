@@ -5,7 +5,9 @@ with ipdb.launch_ipdb_on_exception():
     from ratebuilder import CombinedRateBuilder
     from ratebuilder import OURateBuilder
     from ratebuilder import LegacyRateBuilder
-    from ratebuilder.combination_funcs import combine_sigmoid
+    from ratebuilder import ConstRateBuilder
+    from ratebuilder.combination_funcs import combine_sigmoid, combine_weighted_sum
+    from ratebuilder.comb_rate_gen import hist_match_rows
 
     import matplotlib
     matplotlib.use('Agg')
@@ -88,6 +90,107 @@ def test2():
     comb_rate_hist_fig.savefig('combined_rate_hist.png', format='png', dpi=300)
 
 
+def test3():
+    """
+    ASSUMPTION:
+    OURateBuilder is tested and working
+
+    TEST:
+    Tests that with use_hist_eq, the rate distribution of every channel of the combined
+    rate array matches that of the first constituent
+    """
+    sim_params = {
+        'steps_per_ms': 1,
+        'channels': range(0, 20),
+        'time_length': 20000
+    }
+
+    ou_rate_bldr1 = OURateBuilder(**dict(sim_params, mean=20, sigma=2, theta=1))
+    ou_rate_bldr2 = OURateBuilder(**dict(sim_params, mean=30, sigma=6, theta=0.1))
+
+    comb_rate_bldr = CombinedRateBuilder(rate_builders=[ou_rate_bldr1, ou_rate_bldr2],
+                                         use_hist_eq=True)
+    comb_rate_bldr.build()
+
+    probs = [0.05, 0.25, 0.5, 0.75, 0.95]
+    template_quantiles = np.quantile(comb_rate_bldr.rate_builders[0].rate_array, probs)
+    channel_quantiles = np.quantile(comb_rate_bldr.rate_array, probs, axis=1)
+    assert np.allclose(channel_quantiles, template_quantiles[:, None], rtol=1e-3), \
+        "The histogram equalization was unsuccessful"
+
+    # An empty template leaves the rates unchanged
+    assert np.array_equal(hist_match_rows(comb_rate_bldr.rate_array, np.zeros((0, 100))), comb_rate_bldr.rate_array), \
+        "The histogram equalization with an empty template changed the rates"
+    print("The histogram equalization was successful")
+
+
+def test4():
+    """
+    ASSUMPTION:
+    OURateBuilder is tested and working
+
+    TEST:
+    Tests that a ConstRateBuilder with a scalar rate (here with the default channels=[])
+    adds its rate to every channel of the combination, whereas one with per-channel
+    rates adds them to its own channels only
+    """
+    sim_params = {
+        'steps_per_ms': 1,
+        'time_length': 1000
+    }
+
+    ou_rate_bldr = OURateBuilder(**dict(sim_params, channels=range(0, 10), mean=20, sigma=2, theta=1))
+    scalar_rate_bldr = ConstRateBuilder(**dict(sim_params, rate=5))
+    vector_rate_bldr = ConstRateBuilder(**dict(sim_params, channels=[2, 12], rate=[3, 4]))
+
+    for transform in [None, combine_weighted_sum([1, 1, 1]), lambda rate_arrays: sum(rate_arrays)]:
+        comb_rate_bldr = CombinedRateBuilder(rate_builders=[ou_rate_bldr, scalar_rate_bldr, vector_rate_bldr],
+                                             transform=transform)
+        comb_rate_bldr.build()
+
+        expected_rate_array = np.zeros((11, 1000))
+        expected_rate_array[:10] = comb_rate_bldr.rate_builders[0].rate_array
+        expected_rate_array += 5
+        expected_rate_array[[2, 10]] += np.array([[3], [4]])
+        assert np.array_equal(comb_rate_bldr.channels, list(range(0, 10)) + [12]), \
+            "The combined channels are incorrect"
+        assert np.allclose(comb_rate_bldr.rate_array, expected_rate_array), \
+            "The scalar constant rate was not broadcast to all the channels"
+    print("The scalar constant rate was broadcast to all the channels")
+
+
+def test5():
+    """
+    ASSUMPTION:
+    OURateBuilder.iter_chunks is tested and working
+
+    TEST:
+    Tests that with use_hist_eq, the chunks generated by iter_chunks (equalized using
+    quantile sketches) have the same per-channel rate distribution as the rate array
+    of build() (equalized using the exact quantiles)
+    """
+    sim_params = {
+        'steps_per_ms': 1,
+        'channels': range(0, 20),
+        'time_length': 20000
+    }
+
+    ou_rate_bldr1 = OURateBuilder(**dict(sim_params, mean=20, sigma=2, theta=1, seed=1))
+    ou_rate_bldr2 = OURateBuilder(**dict(sim_params, mean=30, sigma=6, theta=0.1, seed=2))
+
+    comb_rate_bldr = CombinedRateBuilder(rate_builders=[ou_rate_bldr1, ou_rate_bldr2],
+                                         use_hist_eq=True)
+    streamed_rate_array = np.concatenate(list(comb_rate_bldr.iter_chunks(3000)), axis=1)
+    built_rate_array = comb_rate_bldr.build_copy().rate_array
+
+    probs = [0.05, 0.25, 0.5, 0.75, 0.95]
+    streamed_quantiles = np.quantile(streamed_rate_array, probs, axis=1)
+    built_quantiles = np.quantile(built_rate_array, probs, axis=1)
+    assert np.allclose(streamed_quantiles, built_quantiles, atol=0.02), \
+        "The streamed histogram equalization does not match that of build()"
+    print("The streamed histogram equalization was successful")
+
+
 if __name__ == '__main__':
     with ipdb.launch_ipdb_on_exception():
         print("Starting test 1")
@@ -100,3 +203,18 @@ if __name__ == '__main__':
               "to those in the provided legacy_hist.png")
         test2()
         print("Completed Test 2")
+        print("")
+
+        print("Starting Test 3")
+        test3()
+        print("Completed Test 3")
+        print("")
+
+        print("Starting Test 4")
+        test4()
+        print("Completed Test 4")
+        print("")
+
+        print("Starting Test 5")
+        test5()
+        print("Completed Test 5")
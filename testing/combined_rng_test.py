@@ -0,0 +1,53 @@
+from ratebuilder import OURateBuilder
+from spikebuilder import RateBasedSpikeBuilder, CombinedSpikeBuilder
+
+import numpy as np
+import ipdb
+
+
+def main():
+    """
+    TEST:
+    With rng specified, the result of a CombinedSpikeBuilder must only depend on rng and
+    the positions of the repeat instances, and not on the order of the spike builders
+    or the state of any other generator. In particular, the rate builders of the
+    constituent RateBasedSpikeBuilders (which use the global numpy generator here) must
+    draw from generators spawned from rng as well. An int seed must behave as a
+    SeedSequence, i.e. a repeated build must give a new realisation
+    """
+    sim_params = {
+        'steps_per_ms': 1,
+        'channels': range(0, 20),
+        'time_length': 2000
+    }
+    spike_builder1 = RateBasedSpikeBuilder(OURateBuilder(**dict(sim_params, mean=20, sigma=2, theta=1)))
+    spike_builder2 = RateBasedSpikeBuilder(OURateBuilder(**dict(sim_params, mean=40, sigma=4, theta=0.5)))
+
+    np.random.seed(1)
+    combined_builder = CombinedSpikeBuilder(spike_builder_list=[spike_builder1, spike_builder2],
+                                            repeat_instances_list=[(0, 0), (1000, 1), (3000, 0)],
+                                            rng=42)
+    combined_builder.build()
+
+    # The spike builders in permuted order (with the same repeat instances)
+    np.random.seed(2)
+    permuted_builder = CombinedSpikeBuilder(spike_builder_list=[spike_builder2, spike_builder1],
+                                            repeat_instances_list=[(0, 1), (1000, 0), (3000, 1)],
+                                            rng=42)
+    permuted_builder.build()
+
+    assert all(np.array_equal(x, y) for x, y in zip(combined_builder.spike_flat_arrays,
+                                                    permuted_builder.spike_flat_arrays)), \
+        "The combined spikes depend on the order of the builds"
+    print("The combined spikes are independent of the order of the builds")
+
+    rebuilt_builder = combined_builder.build_copy()
+    assert not all(np.array_equal(x, y) for x, y in zip(combined_builder.spike_flat_arrays,
+                                                        rebuilt_builder.spike_flat_arrays)), \
+        "A repeated build with an int seed repeats the same realisation"
+    print("A repeated build gives a new realisation")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        main()
@@ -0,0 +1,140 @@
+from ratebuilder import OURateBuilder, ConstRateBuilder
+from spikebuilder import RateBasedSpikeBuilder
+from spikebuilder.flat_spikes import spike_arrays_to_flat, flat_to_spike_arrays, dense_to_flat
+
+import numpy as np
+import ipdb
+
+
+def test1():
+    """
+    TEST:
+    The conversions between the flat (CSR) spike arrays and the legacy per-channel
+    object arrays (and dense spike count arrays) must be exact inverses, including for
+    channels without spikes, and the object arrays of a built spike builder must be
+    those of its flat arrays
+    """
+    rng = np.random.default_rng(0)
+    spike_count_array = rng.poisson(0.2, size=(30, 500)).astype(np.uint32)
+    spike_count_array[[0, 7, 29]] = 0
+
+    # legacy object arrays of the dense counts
+    spike_rel_step_array = np.ndarray(30, dtype=object)
+    spike_weight_array = np.ndarray(30, dtype=object)
+    for i, channel_counts in enumerate(spike_count_array):
+        spike_rel_step_array[i] = np.nonzero(channel_counts)[0].astype(np.uint32)
+        spike_weight_array[i] = channel_counts[spike_rel_step_array[i]]
+
+    indptr, steps, weights = spike_arrays_to_flat(spike_rel_step_array, spike_weight_array)
+    dense_flat_arrays = dense_to_flat(spike_count_array)
+    assert all(np.array_equal(x, y) for x, y in zip((indptr, steps, weights), dense_flat_arrays)), \
+        "The flat arrays of the object arrays differ from those of the dense counts"
+
+    round_trip_step_array, round_trip_weight_array = flat_to_spike_arrays(indptr, steps, weights)
+    assert all(np.array_equal(x, y) for x, y in zip(round_trip_step_array, spike_rel_step_array)), \
+        "The round trip changed the spike steps"
+    assert all(np.array_equal(x, y) for x, y in zip(round_trip_weight_array, spike_weight_array)), \
+        "The round trip changed the spike weights"
+
+    spike_builder = RateBasedSpikeBuilder(ConstRateBuilder(50, channels=range(10), time_length=1000),
+                                          rng=np.random.default_rng(1))
+    spike_builder.build()
+    built_flat_arrays = spike_arrays_to_flat(spike_builder.spike_rel_step_array, spike_builder.spike_weight_array)
+    assert all(np.array_equal(x, y) for x, y in zip(built_flat_arrays, spike_builder.spike_flat_arrays)), \
+        "The object arrays of the spike builder differ from its flat arrays"
+    print("The flat and object array conversions are exact inverses")
+
+
+def test2():
+    """
+    TEST:
+    The 'inversion' engine (sparse, generates only the spikes that occur) and the
+    'dense' engine must give spike counts with the same statistics, i.e. those of a
+    Poisson process with the rates of the rate builder
+    """
+    ou_rate_builder = OURateBuilder(mean=20, sigma=2, theta=1, steps_per_ms=2, channels=range(0, 200),
+                                    time_length=20000, seed=3)
+    ou_rate_builder.build()
+    expected_counts = np.sum(ou_rate_builder.rate_array, axis=1)/ou_rate_builder.steps_per_ms/1000
+
+    for engine in ['dense', 'inversion']:
+        spike_builder = RateBasedSpikeBuilder(ou_rate_builder, engine=engine, rng=np.random.default_rng(4))
+        spike_builder.build()
+        indptr, __, weights = spike_builder.spike_flat_arrays
+        nchannels = indptr.size - 1
+        spike_counts = np.bincount(np.repeat(np.arange(nchannels), np.diff(indptr)), weights=weights,
+                                   minlength=nchannels)
+
+        # The normalized deviations of the counts are standard normal
+        normalized_deviations = (spike_counts - expected_counts)/np.sqrt(expected_counts)
+        print("{:<10}: Mean normalized deviation {:<10.5f}Variance {:<10.5f}".format(
+            engine, np.mean(normalized_deviations), np.var(normalized_deviations)))
+        assert abs(np.mean(normalized_deviations)) < 4/np.sqrt(len(expected_counts)), \
+            "The mean spike count is incorrect (engine={})".format(engine)
+        assert abs(np.var(normalized_deviations) - 1) < 0.3, \
+            "The variance of the spike counts is incorrect (engine={})".format(engine)
+    print("The spike count statistics of the engines match")
+
+
+def test3():
+    """
+    TEST:
+    The simulator exporters must give exactly the spikes of spike_time_array and
+    spike_weight_array, with the senders in the order of channels
+    """
+    spike_builder = RateBasedSpikeBuilder(ConstRateBuilder(5, channels=[5, 2, 9, 4], steps_per_ms=2,
+                                                           time_length=2000),
+                                          rng=np.random.default_rng(5))
+    spike_builder.build()
+    start_time = 1.5
+    spike_time_array = spike_builder.spike_time_array(start_time)
+    spike_weight_array = spike_builder.spike_weight_array
+    neuron_ids = [100 + channel for channel in spike_builder.channels.tolist()]
+
+    senders, times, weights = spike_builder.export_flat_spikes(start_time, neuron_ids=neuron_ids)
+    for neuron_id, channel_times, channel_weights in zip(neuron_ids, spike_time_array, spike_weight_array):
+        is_sender = senders == neuron_id
+        assert np.array_equal(times[is_sender], channel_times), "export_flat_spikes gives the wrong times"
+        assert np.array_equal(weights[is_sender], channel_weights), "export_flat_spikes gives the wrong weights"
+
+    nest_params = spike_builder.export_nest_spike_generators(start_time)
+    assert list(nest_params.keys()) == spike_builder.channels.tolist(), \
+        "export_nest_spike_generators gives the wrong senders"
+    for channel_params, channel_times, channel_weights in zip(nest_params.values(), spike_time_array,
+                                                              spike_weight_array):
+        assert np.array_equal(channel_params['spike_times'], channel_times), \
+            "export_nest_spike_generators gives the wrong times"
+        assert np.array_equal(channel_params['spike_multiplicities'], channel_weights), \
+            "export_nest_spike_generators gives the wrong weights"
+
+    # At 5Hz and 0.5ms steps, there are multiple spikes in a step only rarely, in which
+    # case the Brian2 export must fail
+    if all(np.all(channel_weights == 1) for channel_weights in spike_weight_array):
+        indices, times = spike_builder.export_brian2_spikes(start_time)
+        for i, channel_times in enumerate(spike_time_array):
+            assert np.array_equal(times[indices == i], channel_times), "export_brian2_spikes gives the wrong times"
+    else:
+        try:
+            spike_builder.export_brian2_spikes(start_time)
+        except ValueError:
+            pass
+        else:
+            assert False, "export_brian2_spikes accepted spikes with weight > 1"
+    print("The exported spikes match spike_time_array")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        print("Starting Test 1")
+        test1()
+        print("Completed Test 1")
+        print("")
+
+        print("Starting Test 2")
+        test2()
+        print("Completed Test 2")
+        print("")
+
+        print("Starting Test 3")
+        test3()
+        print("Completed Test 3")
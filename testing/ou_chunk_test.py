@@ -0,0 +1,40 @@
+from ratebuilder import OURateBuilder
+
+import numpy as np
+import ipdb
+
+
+def main():
+    """
+    TEST:
+    The rate pattern generated chunk by chunk via iter_chunks must have the same
+    statistics (mean, variance, one step correlation) as the monolithic build. In
+    particular, the chunk boundaries must not introduce discontinuities
+    """
+    mean = 2.0
+    sigma = 4.0
+    theta = 2.0
+
+    ou_gen = OURateBuilder(mean=mean, sigma=sigma, theta=theta,
+                           steps_per_ms=1, time_length=5000, channels=range(0, 2000),
+                           rng=np.random.RandomState(30))
+
+    chunks = list(ou_gen.iter_chunks(chunk_steps=333))
+    assert all(chunk.shape[1] <= 333 for chunk in chunks)
+    rate_array = np.hstack(chunks)
+    assert rate_array.shape == (2000, 5000), "The chunks do not span the time length"
+
+    # Correlation across chunk boundaries only
+    boundary_inds = np.arange(333, 5000, 333)
+    boundary_corr = np.mean((rate_array[:, boundary_inds - 1] - mean)*(rate_array[:, boundary_inds] - mean))
+
+    print("Mean         : {:<10.5f}Expected: {:10.5f}".format(np.mean(rate_array), mean))
+    print("Variance     : {:<10.5f}Expected: {:10.5f}".format(np.mean((rate_array - mean)**2),
+                                                              sigma**2/(2*theta)))
+    print("BoundaryCorr : {:<10.5f}Expected: {:10.5f}".format(boundary_corr,
+                                                              sigma**2*np.exp(-theta)/(2*theta)))
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        main()
@@ -0,0 +1,75 @@
+from ratebuilder import OURateBuilder
+
+import numpy as np
+import ipdb
+
+
+def get_statistics(rate_array, mean):
+    """
+    Returns the mean, variance and one step autocorrelation coefficient of rate_array
+    (pooled over all channels), taking mean as the known mean of the process
+    """
+    variance = np.mean((rate_array - mean)**2)
+    one_step_corr = np.mean((rate_array[:, :-1] - mean)*(rate_array[:, 1:] - mean))/variance
+    return np.mean(rate_array), variance, one_step_corr
+
+
+def test1():
+    """
+    TEST:
+    The 'numba' and 'scipy' engines generate different realisations, but of the same
+    process. Hence the mean, variance and one step autocorrelation of the rate arrays
+    generated by both must match each other (and the values expected for the OU process)
+    """
+    mean = 20.0
+    sigma = 4.0
+    theta = 0.5
+
+    ou_params = dict(mean=mean, sigma=sigma, theta=theta, steps_per_ms=1, time_length=5000, channels=range(0, 2000))
+    scipy_stats = get_statistics(OURateBuilder(**ou_params, engine='scipy', rng=np.random.default_rng(1))
+                                 .build().rate_array, mean)
+    numba_stats = get_statistics(OURateBuilder(**ou_params, engine='numba', rng=np.random.default_rng(2))
+                                 .build().rate_array, mean)
+    expected_stats = (mean, sigma**2/(2*theta), np.exp(-theta))
+
+    for stat_name, scipy_stat, numba_stat, expected_stat in zip(['Mean', 'Variance', 'OneStepCorr'],
+                                                                scipy_stats, numba_stats, expected_stats):
+        print("{:<12}: scipy {:<10.5f}numba {:<10.5f}Expected: {:10.5f}".format(
+            stat_name, scipy_stat, numba_stat, expected_stat))
+    assert np.allclose(scipy_stats, numba_stats, rtol=0.02), \
+        "The statistics of the 'numba' and 'scipy' engines differ"
+    assert np.allclose(numba_stats, expected_stats, rtol=0.05), \
+        "The statistics of the 'numba' engine differ from those of the OU process"
+    print("The statistics of the engines match")
+
+
+def test2():
+    """
+    TEST:
+    For either engine, builds with the same seed (per-channel streams) or with
+    generators seeded identically must give identical rate arrays
+    """
+    ou_params = dict(mean=20, sigma=4, theta=0.5, steps_per_ms=1, time_length=1000, channels=range(0, 100))
+    for engine in ['scipy', 'numba']:
+        seeded_rate_arrays = [OURateBuilder(**ou_params, engine=engine, seed=7).build().rate_array
+                              for __ in range(2)]
+        assert np.array_equal(*seeded_rate_arrays), \
+            "Builds with the same seed differ (engine={})".format(engine)
+
+        rng_rate_arrays = [OURateBuilder(**ou_params, engine=engine, rng=np.random.default_rng(7)).build().rate_array
+                           for __ in range(2)]
+        assert np.array_equal(*rng_rate_arrays), \
+            "Builds with identically seeded generators differ (engine={})".format(engine)
+    print("The seeded builds are reproducible")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        print("Starting Test 1")
+        test1()
+        print("Completed Test 1")
+        print("")
+
+        print("Starting Test 2")
+        test2()
+        print("Completed Test 2")
@@ -0,0 +1,42 @@
+from ratebuilder import OURateBuilder
+
+import numpy as np
+import ipdb
+
+
+def main():
+    """
+    TEST:
+    With the same seed, extending a build of time length t0 by t1 via extend must give
+    the same rate array (up to floating point rounding) as a single build of time
+    length t0 + t1, for either engine and with per-channel parameters. This holds
+    both when the streams are continued directly and when the draws of the existing
+    steps are discarded (after a sharded build). The original builder must not be
+    modified
+    """
+    channels = range(0, 50)
+    for engine in ['scipy', 'numba']:
+        ou_params = dict(mean=20, sigma=4, theta=0.5, steps_per_ms=2, channels=channels, engine=engine, seed=5)
+        single_builder = OURateBuilder(**ou_params, time_length=1500)
+        single_builder.sigma = np.linspace(1, 4, len(channels))
+        single_builder.build()
+
+        for workers in [1, 2]:
+            builder = OURateBuilder(**ou_params, time_length=1000, workers=workers)
+            builder.sigma = np.linspace(1, 4, len(channels))
+            builder.build()
+            rate_array = builder.rate_array
+            extended_builder = builder.extend(1200).extend(1500)
+            assert builder.rate_array is rate_array and builder.time_length == 1000, \
+                "extend modified the original builder (engine={}, workers={})".format(engine, workers)
+
+            assert extended_builder.rate_array.shape == single_builder.rate_array.shape, \
+                "The extended build has the wrong shape (engine={}, workers={})".format(engine, workers)
+            assert np.allclose(extended_builder.rate_array, single_builder.rate_array, rtol=1e-10, atol=1e-10), \
+                "The extended build differs from the single build (engine={}, workers={})".format(engine, workers)
+    print("The extended builds are identical to the single builds")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        main()
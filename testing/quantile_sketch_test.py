@@ -0,0 +1,36 @@
+from ratebuilder.quantile_sketch import QuantileSketch
+
+import numpy as np
+import ipdb
+
+
+def main():
+    """
+    TEST:
+    The quantiles (and CDF) estimated by a QuantileSketch of a skewed dataset, built by
+    updating sketches with separate chunks and merging them, must match the exact
+    quantiles to within the accuracy expected for the sketch size
+    """
+    rng = np.random.default_rng(0)
+    data = np.concatenate([rng.normal(0, 1, 200000), rng.exponential(3, 100000)])
+    rng.shuffle(data)
+
+    chunk_sketches = [QuantileSketch(size=1024).update(chunk) for chunk in np.array_split(data, 7)]
+    sketch = chunk_sketches[0]
+    for chunk_sketch in chunk_sketches[1:]:
+        sketch.merge(chunk_sketch)
+
+    probs = np.linspace(0.01, 0.99, 99)
+    exact_quantiles = np.quantile(data, probs)
+    assert sketch.count == data.size, "The sketch does not summarise all the values"
+    assert sketch.min == np.amin(data) and sketch.max == np.amax(data), "The extremes are not exact"
+    assert np.max(np.abs(sketch.cdf(exact_quantiles) - probs)) < 1/1024, \
+        "The CDF estimated by the sketch is inaccurate"
+    assert np.allclose(sketch.quantile(probs), exact_quantiles, atol=0.02), \
+        "The quantiles estimated by the sketch are inaccurate"
+    print("The quantiles estimated by the sketch are accurate")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        main()
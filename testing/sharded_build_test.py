@@ -0,0 +1,59 @@
+from ratebuilder import OURateBuilder, ConstRateBuilder
+from spikebuilder import RateBasedSpikeBuilder
+
+import numpy as np
+import ipdb
+
+
+def test1():
+    """
+    TEST:
+    With per-channel streams (seed), the channel-sharded build of an OURateBuilder with
+    per-channel parameters must be identical to the single process build
+    """
+    channels = [3, 1, 7, 5, 2, 9, 4]
+    ou_rate_builder = OURateBuilder(mean=0, sigma=1, theta=1, channels=channels, time_length=1000, seed=11)
+    ou_rate_builder.mean = np.asarray(ou_rate_builder.channels, dtype=np.float64)*10
+    ou_rate_builder.sigma = np.linspace(1, 4, len(channels))
+
+    single_rate_array = ou_rate_builder.build_copy().rate_array
+    ou_rate_builder.workers = 3
+    sharded_rate_array = ou_rate_builder.build_copy().rate_array
+    assert np.array_equal(single_rate_array, sharded_rate_array), \
+        "The sharded build differs from the single process build"
+    print("The sharded build is identical to the single process build")
+
+
+def test2():
+    """
+    TEST:
+    The channel-sharded build of a RateBasedSpikeBuilder over a ConstRateBuilder with
+    per-channel rates must give each channel its own rate
+    """
+    channels = [3, 1, 7, 5, 2, 9, 4]
+    time_length = 50000
+    const_rate_builder = ConstRateBuilder(0, channels=channels, time_length=time_length)
+    rates = np.asarray(const_rate_builder.channels, dtype=np.float64)*10
+    const_rate_builder.rate = rates
+
+    spike_builder = RateBasedSpikeBuilder(const_rate_builder, rng=np.random.default_rng(3), workers=3)
+    spike_builder.build()
+
+    # The spike counts are Poisson distributed with mean rate*time_length
+    expected_counts = rates*time_length/1000
+    spike_counts = np.diff(spike_builder.spike_flat_arrays.indptr)
+    assert np.all(np.abs(spike_counts - expected_counts) < 5*np.sqrt(expected_counts)), \
+        "The spike counts do not match the per-channel rates"
+    print("The sharded build uses the per-channel rates")
+
+
+if __name__ == '__main__':
+    with ipdb.launch_ipdb_on_exception():
+        print("Starting Test 1")
+        test1()
+        print("Completed Test 1")
+        print("")
+
+        print("Starting Test 2")
+        test2()
+        print("Completed Test 2")